@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" License
+
+    Copyright (C) 2013 YunoHost
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program; if not, see http://www.gnu.org/licenses
+
+"""
+
+"""
+    Benchmarks and performance regression checks
+
+    Usage: python benchmark.py <benchmark> [arguments]
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+
+# Import time budget of every command module, in milliseconds
+import_budgets = {
+    'yunohost'         : 150,
+    'yunohost_app'     : 250,
+    'yunohost_backup'  : 200,
+    'yunohost_domain'  : 200,
+    'yunohost_dyndns'  : 200,
+    'yunohost_firewall': 200,
+    'yunohost_hook'    : 200,
+    'yunohost_monitor' : 200,
+    'yunohost_service' : 200,
+    'yunohost_tools'   : 200,
+    'yunohost_user'    : 200,
+}
+
+# Modules which must only be imported by the functions needing them
+heavy_modules = [
+    'miniupnpc', 'psutil', 'xmlrpclib', 'requests',
+    'yunohost_app', 'yunohost_dyndns', 'yunohost_backup'
+]
+
+import_probe = """
+import sys, time, json, gettext
+gettext.install('YunoHost')
+before = set(sys.modules)
+start = time.time()
+__import__(sys.argv[1])
+elapsed = (time.time() - start) * 1000
+loaded = [m for m in set(sys.modules) - before if sys.modules[m] is not None]
+print(json.dumps({ 'time': elapsed, 'modules': sorted(loaded) }))
+"""
+
+
+def bench_imports(runs=5):
+    """
+    Import every command module in a fresh interpreter and check its cost
+
+    Keyword argument:
+        runs -- Number of imports per module, the fastest one is kept
+
+    Returns:
+        0 if every module is within its budget, 1 otherwise
+
+    """
+    runs = int(runs)
+    failures = 0
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    for module, budget in sorted(import_budgets.items()):
+        timings = []
+        for i in range(runs):
+            output = subprocess.check_output([sys.executable, '-c', import_probe, module], cwd=cwd)
+            probe = json.loads(output.strip().split('\n')[-1])
+            timings.append(probe['time'])
+
+        heavy = [m for m in probe['modules'] if m in heavy_modules and m != module]
+        status = 'ok'
+        if min(timings) > budget or heavy:
+            status = 'FAIL'
+            failures += 1
+
+        print('%-18s %7.1f ms (budget %4d ms) %4d modules  %s%s' % (
+            module, min(timings), budget, len(probe['modules']), status,
+            '  heavy: '+ ', '.join(heavy) if heavy else ''))
+
+    return 1 if failures else 0
+
+
+def bench_ldap_update(password, edits=500, batch=50):
+    """
+    Measure LDAP entry edits per second against the local slapd
+
+    Temporary cn=yunohost-benchmark-N entries are edited with update()
+    reading each entry first, with update() given the known values, and
+    with update_many(), then removed.
+
+    Keyword argument:
+        password -- LDAP admin password
+        edits -- Number of edits per mode
+        batch -- Number of entries, edited at once by update_many()
+
+    Returns:
+        0
+
+    """
+    import gettext
+    gettext.install('YunoHost')
+    from yunohost import YunoHostLDAP
+
+    edits, batch = int(edits), int(batch)
+    rdns = ['cn=yunohost-benchmark-%d' % i for i in range(batch)]
+
+    with YunoHostLDAP(password=password) as yldap:
+        for rdn in rdns:
+            yldap.add(rdn, {
+                'objectClass': ['organizationalRole', 'top'],
+                'cn'         : rdn[3:],
+                'description': '0'
+            })
+        try:
+            start = time.time()
+            for i in range(edits):
+                yldap.update(rdns[i % batch], { 'description': str(i) })
+            timings = [('update, read first', time.time() - start)]
+
+            current = dict((rdn, yldap.search(rdn +','+ yldap.base, attrs=['description'], cache=False)[0]) for rdn in rdns)
+            start = time.time()
+            for i in range(edits):
+                rdn = rdns[i % batch]
+                yldap.update(rdn, { 'description': str(i) }, old_attr_dict=current[rdn])
+                current[rdn] = { 'description': [str(i)] }
+            timings.append(('update, known values', time.time() - start))
+
+            start = time.time()
+            for i in range(0, edits, batch):
+                yldap.update_many([(rdn, { 'description': str(i + j) }, None)
+                                   for j, rdn in enumerate(rdns[:edits - i])])
+            timings.append(('update_many', time.time() - start))
+        finally:
+            for rdn in rdns:
+                yldap.remove(rdn)
+
+    for mode, elapsed in timings:
+        print('%-22s %8.1f edits/s' % (mode, edits / elapsed))
+    return 0
+
+
+def bench_user_import(password, users=500):
+    """
+    Measure users created per second by user_import()
+
+    Users yunohost_bench_N are imported from a generated CSV file, then
+    removed from LDAP with their home directory.
+
+    Keyword argument:
+        password -- LDAP admin password
+        users -- Number of users to import
+
+    Returns:
+        0
+
+    """
+    import gettext
+    import shutil
+    import tempfile
+    gettext.install('YunoHost')
+    from yunohost import YunoHostError, YunoHostLDAP, ldap_pool
+    from yunohost_app import app_ssowatconf
+    from yunohost_domain import domain_list
+    from yunohost_user import user_import
+
+    users = int(users)
+    fd, path = tempfile.mkstemp(suffix='.csv')
+
+    with ldap_pool.connection(password):
+        domain = domain_list()['Domains'][0]
+        with os.fdopen(fd, 'w') as f:
+            f.write('username,firstname,lastname,mail,password\n')
+            for i in range(users):
+                f.write('yunohost_bench_%d,Bench,%d,yunohost_bench_%d@%s,benchmark\n' % (i, i, i, domain))
+        try:
+            start = time.time()
+            result = user_import(path)
+            elapsed = time.time() - start
+        finally:
+            os.remove(path)
+            with YunoHostLDAP() as yldap:
+                for i in range(users):
+                    try: yldap.remove('uid=yunohost_bench_%d,ou=users' % i)
+                    except YunoHostError: pass
+                    shutil.rmtree('/home/yunohost_bench_%d' % i, ignore_errors=True)
+            app_ssowatconf(quiet=True)
+
+    print('%-22s %8.1f users/s (%d created)' % ('user_import', users / elapsed, len(result['Created'])))
+    return 0
+
+
+def bench_user_password(password, users=50, resets=500):
+    """
+    Measure password resets per second
+
+    Users yunohost_bench_N are imported, their passwords are reset with
+    smbldap-passwd when installed, one by one in process, then all at
+    once, and the users are deleted.
+
+    Keyword argument:
+        password -- LDAP admin password
+        users -- Number of users
+        resets -- Number of resets per mode
+
+    Returns:
+        0
+
+    """
+    import gettext
+    import tempfile
+    gettext.install('YunoHost')
+    from yunohost import YunoHostLDAP, ldap_pool
+    from yunohost_domain import domain_list
+    from yunohost_user import user_import, user_delete, set_passwords
+
+    users, resets = int(users), int(resets)
+    usernames = ['yunohost_bench_%d' % i for i in range(users)]
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    timings = []
+
+    with ldap_pool.connection(password):
+        domain = domain_list()['Domains'][0]
+        with os.fdopen(fd, 'w') as f:
+            f.write('username,firstname,lastname,mail,password\n')
+            for username in usernames:
+                f.write('%s,Bench,User,%s@%s,benchmark\n' % (username, username, domain))
+        try:
+            user_import(path)
+            if os.path.exists('/usr/sbin/smbldap-passwd'):
+                count = min(resets, users)
+                start = time.time()
+                for i in range(count):
+                    passwd = subprocess.Popen(['/usr/sbin/smbldap-passwd', usernames[i]], stdin=subprocess.PIPE)
+                    passwd.communicate('benchmark%d\nbenchmark%d\n' % (i, i))
+                timings.append(('smbldap-passwd', count, time.time() - start))
+
+            with YunoHostLDAP() as yldap:
+                start = time.time()
+                for i in range(resets):
+                    set_passwords(yldap, { usernames[i % users]: 'benchmark%d' % i })
+                timings.append(('one by one', resets, time.time() - start))
+
+                start = time.time()
+                for i in range(0, resets, users):
+                    set_passwords(yldap, dict((username, 'benchmark%d' % (i + j))
+                                               for j, username in enumerate(usernames[:resets - i])))
+                timings.append(('all at once', resets, time.time() - start))
+        finally:
+            os.remove(path)
+            user_delete(usernames, purge=True)
+
+    for mode, count, elapsed in timings:
+        print('%-22s %8.1f resets/s' % (mode, count / elapsed))
+    return 0
+
+
+def bench_certificates(domains=20):
+    """
+    Measure certificates generated per second for domain_add()
+
+    A copy of the local CA is made in a temporary directory, then
+    certificates are generated with the openssl command, with pyOpenSSL,
+    and with pyOpenSSL taking the keys from a filled key pool.
+
+    Keyword argument:
+        domains -- Number of certificates per mode
+
+    Returns:
+        0
+
+    """
+    import gettext
+    import shutil
+    import tempfile
+    from multiprocessing.pool import ThreadPool
+    gettext.install('YunoHost')
+    import yunohost_domain
+
+    domains = int(domains)
+    tmp_dir = tempfile.mkdtemp()
+    paths = (yunohost_domain.ssl_dir, yunohost_domain.certs_dir, yunohost_domain.key_pool_dir)
+    ssl_dir = paths[0]
+    try:
+        shutil.copytree(ssl_dir, tmp_dir +'/yunoCA', symlinks=True)
+        with open(tmp_dir +'/yunoCA/openssl.cnf') as f:
+            conf = f.read().replace(ssl_dir, tmp_dir +'/yunoCA')
+        with open(tmp_dir +'/yunoCA/openssl.cnf', 'w') as f:
+            f.write(conf)
+        yunohost_domain.ssl_dir = tmp_dir +'/yunoCA'
+        yunohost_domain.certs_dir = tmp_dir +'/certs'
+        yunohost_domain.key_pool_dir = tmp_dir +'/keys'
+
+        crypto = yunohost_domain._crypto()
+        modes = [('openssl', yunohost_domain._domain_certificate)]
+        if crypto is None:
+            print('pyOpenSSL is not installed, only the openssl command is measured')
+        else:
+            native = lambda domain: yunohost_domain._domain_certificate_native(domain, crypto)
+            modes += [('pyOpenSSL', native), ('pyOpenSSL, key pool', native)]
+
+        timings = []
+        for n, (mode, func) in enumerate(modes):
+            if mode.endswith('key pool'):
+                yunohost_domain.domain_keypool(domains)
+            names = ['%d-%d.benchmark.yunohost.org' % (n, i) for i in range(domains)]
+            pool = ThreadPool(yunohost_domain.domain_workers)
+            start = time.time()
+            pool.map(func, names)
+            timings.append((mode, time.time() - start))
+            pool.close()
+    finally:
+        yunohost_domain.ssl_dir, yunohost_domain.certs_dir, yunohost_domain.key_pool_dir = paths
+        shutil.rmtree(tmp_dir)
+
+    for mode, elapsed in timings:
+        print('%-22s %8.1f certificates/s' % (mode, domains / elapsed))
+    return 0
+
+
+def main():
+    benchmarks = dict((name[6:], func) for name, func in globals().items()
+                      if name.startswith('bench_'))
+
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print('Usage: python benchmark.py {'+ ','.join(sorted(benchmarks)) +'} [arguments]')
+        return 1
+
+    return benchmarks[sys.argv[1]](*sys.argv[2:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,27 @@
 import re
-from itertools import ifilter
 from functools import wraps
 from twisted.web.resource import Resource, NoResource
 
+# Anchored routes made of literal segments and named captures, such as
+# '^/users/(?P<username>[^/]+)$', are indexed in a trie; any other
+# regex is matched linearly as before.
+_route_re = re.compile(r'^\^((?:/(?:(?:[\w~-]|\\\.)+|\(\?P<\w+>\[\^/\]\+\)))+)\$$')
+_segment_re = re.compile(r'/(?:(?P<literal>(?:[\w~-]|\\\.)+)|\(\?P<(?P<param>\w+)>\[\^/\]\+\))')
+
+def _split_route(regex):
+    """Return the (literal, param) segments of a route regex, or None"""
+    match = _route_re.match(regex)
+    if match is None:
+        return None
+    segments = []
+    for segment in _segment_re.finditer(match.group(1)):
+        if segment.group('param'):
+            segments.append((None, segment.group('param')))
+        else:
+            segments.append((segment.group('literal').replace('\\.', '.'), None))
+    return segments
+
+
 class _FakeResource(Resource):
     _result = ''
     isLeaf = True
@@ -23,6 +42,14 @@ def maybeResource(f):
     return inner
 
 
+class _RouteNode(object):
+    __slots__ = ('children', 'params', 'routes')
+    def __init__(self):
+        self.children = {}  # literal segment -> node
+        self.params = {}    # capture name -> node
+        self.routes = []    # (registration index, callback) ending here
+
+
 class APIResource(Resource):
 
     _registry = None
@@ -30,19 +57,79 @@ class APIResource(Resource):
     def __init__(self, *args, **kwargs):
         Resource.__init__(self, *args, **kwargs)
         self._registry = []
+        self._trie = {}
+        self._fallback = []
+
+    def _index(self, position):
+        method, regex, callback = self._registry[position]
+        segments = _split_route(regex.pattern)
+        if segments is None:
+            self._fallback.append((position, method, regex, callback))
+            return
+        node = self._trie.setdefault(method, _RouteNode())
+        for literal, param in segments:
+            if param is None:
+                node = node.children.setdefault(literal, _RouteNode())
+            else:
+                node = node.params.setdefault(param, _RouteNode())
+        node.routes.append((position, callback))
+
+    def _rebuild(self):
+        self._trie = {}
+        self._fallback = []
+        for position in range(len(self._registry)):
+            self._index(position)
+
+    def _match(self, node, segments, depth, kwargs):
+        # First registered (index, callback, kwargs) matching segments[depth:]
+        if depth == len(segments):
+            if node.routes:
+                position, callback = node.routes[0]
+                return position, callback, dict(kwargs)
+            return None
+        best = None
+        segment = segments[depth]
+        child = node.children.get(segment)
+        if child is not None:
+            best = self._match(child, segments, depth + 1, kwargs)
+        if segment:
+            for name, child in node.params.iteritems():
+                kwargs[name] = segment
+                found = self._match(child, segments, depth + 1, kwargs)
+                del kwargs[name]
+                if found is not None and (best is None or found[0] < best[0]):
+                    best = found
+        return best
 
     def _get_callback(self, request):
-        filterf = lambda t:t[0] in (request.method, 'ALL')
         path_to_check = getattr(request, '_remaining_path', request.path)
-        for m, r, cb in ifilter(filterf, self._registry):
-            result = r.search(path_to_check)
-            if result:
-                request._remaining_path = path_to_check[result.span()[1]:]
-                return cb, result.groupdict()
+        best = None
+        if path_to_check.startswith('/'):
+            segments = path_to_check[1:].split('/')
+            for method in set((request.method, 'ALL')):
+                root = self._trie.get(method)
+                if root is None:
+                    continue
+                found = self._match(root, segments, 0, {})
+                if found is not None and (best is None or found[0] < best[0]):
+                    best = found
+        # Regexes registered before the best trie route still take precedence
+        for position, m, r, cb in self._fallback:
+            if best is not None and position > best[0]:
+                break
+            if m in (request.method, 'ALL'):
+                result = r.search(path_to_check)
+                if result:
+                    request._remaining_path = path_to_check[result.span()[1]:]
+                    return cb, result.groupdict()
+        if best is not None:
+            request._remaining_path = ''
+            return best[1], best[2]
         return None, None
 
     def register(self, method, regex, callback):
         self._registry.append((method, re.compile(regex), callback))
+        self._index(len(self._registry) - 1)
 
     def unregister(self, method=None, regex=None, callback=None):
         if regex is not None: regex = re.compile(regex)
@@ -51,6 +138,7 @@ class APIResource(Resource):
                 if not regex or (regex and r==regex):
                     if not callback or (callback and cb==callback):
                         self._registry.remove((m, r, cb))
+        self._rebuild()
 
     def getChild(self, name, request):
         r = self.children.get(name, None)
@@ -1,7 +1,10 @@
 import txrestapi
 __package__="txrestapi"
 import re
+import sys
+import time
 import os.path
+from itertools import ifilter
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
 from twisted.web.resource import Resource, NoResource
@@ -127,6 +130,120 @@ class APIResourceTest(unittest.TestCase):
             result = r.getChild('path', req)
             self.assertEqual(result.render(req), 'ALL' if method=='PUT' else method)
 
+    def test_trie_registry(self):
+        r = APIResource()
+        r.register('GET', '^/users/(?P<username>[^/]+)$', 1)
+        r.register('GET', '/regex', 2)
+        self.assertEqual([x[0] for x in r._registry], ['GET', 'GET'])
+        self.assertEqual(r._trie['GET'].children['users'].params['username'].routes,
+                         [(0, 1)])
+        self.assertEqual([x[0] for x in r._fallback], [1])
+
+    def test_trie_args(self):
+        r = APIResource()
+        r.register('GET', '^/users$', 1)
+        r.register('GET', '^/users/(?P<username>[^/]+)$', 2)
+        r.register('GET', '^/app/(?P<app>[^/]+)/setting$', 3)
+        self.assertEqual(r._get_callback(getRequest('GET', '/users')), (1, {}))
+        self.assertEqual(r._get_callback(getRequest('GET', '/users/bob')),
+                         (2, {'username': 'bob'}))
+        self.assertEqual(r._get_callback(getRequest('GET', '/app/mail/setting')),
+                         (3, {'app': 'mail'}))
+        for path in ('/users/', '/users/bob/info', '/app/mail', '/userss'):
+            self.assertEqual(r._get_callback(getRequest('GET', path)), (None, None))
+
+    def test_trie_order(self):
+        r = APIResource()
+        r.register('GET', '^/domains/(?P<domain>[^/]+)$', 1)
+        r.register('GET', '^/domains/main$', 2)
+        r.register('ALL', '^/domain/main$', 3)
+        r.register('PUT', '^/domain/main$', 4)
+        self.assertEqual(r._get_callback(getRequest('GET', '/domains/main'))[0], 1)
+        self.assertEqual(r._get_callback(getRequest('PUT', '/domain/main'))[0], 3)
+
+    def test_trie_and_regex_order(self):
+        r = APIResource()
+        r.register('GET', '^/(?P<a>[^/]*)/info', 1)
+        r.register('GET', '^/users/info$', 2)
+        r.register('GET', '^/domains/info$', 3)
+        r.register('GET', '/domains', 4)
+        self.assertEqual(r._get_callback(getRequest('GET', '/users/info')),
+                         (1, {'a': 'users'}))
+        self.assertEqual(r._get_callback(getRequest('GET', '/domains/info')), (1, {'a': 'domains'}))
+        r.unregister(regex='^/(?P<a>[^/]*)/info')
+        self.assertEqual(r._get_callback(getRequest('GET', '/users/info')), (2, {}))
+        self.assertEqual(r._get_callback(getRequest('GET', '/domains/info')), (3, {}))
+        self.assertEqual(r._get_callback(getRequest('GET', '/domains/list'))[0], 4)
+
+    def test_trie_escaped_literal(self):
+        r = APIResource()
+        r.register('ALL', '^/favicon\\.ico$', 1)
+        r.register('ALL', '^/robots.txt$', 2)
+        self.assertEqual(r._get_callback(getRequest('GET', '/favicon.ico'))[0], 1)
+        self.assertEqual(r._get_callback(getRequest('GET', '/faviconxico'))[0], None)
+        self.assertEqual([x[0] for x in r._fallback], [1])
+
+    def test_trie_unregister(self):
+        r = APIResource()
+        r.register('GET', '^/users$', 1)
+        r.register('POST', '^/users$', 2)
+        r.unregister(method='GET')
+        self.assertEqual(r._get_callback(getRequest('GET', '/users')), (None, None))
+        self.assertEqual(r._get_callback(getRequest('POST', '/users'))[0], 2)
+
+
+class LinearAPIResource(APIResource):
+    """ Previous implementation, scanning every registered regex """
+
+    def _get_callback(self, request):
+        filterf = lambda t:t[0] in (request.method, 'ALL')
+        path_to_check = getattr(request, '_remaining_path', request.path)
+        for m, r, cb in ifilter(filterf, self._registry):
+            result = r.search(path_to_check)
+            if result:
+                request._remaining_path = path_to_check[result.span()[1]:]
+                return cb, result.groupdict()
+        return None, None
+
+
+class RoutingBenchmark(unittest.TestCase):
+
+    def _routes(self):
+        # Roughly what yunohost.tac registers from action_map.yml
+        routes = []
+        for category in ('user', 'domain', 'app', 'backup', 'monitor', 'service',
+                         'firewall', 'dyndns', 'tools', 'hook'):
+            for action in ('list', 'create', 'delete', 'info', 'update',
+                           'install', 'remove', 'upgrade'):
+                routes.append(('GET', '/%ss/%s' % (category, action)))
+                routes.append(('PUT', '/%s/%s/(?P<name>[^/]+)' % (category, action)))
+        return routes
+
+    def _rate(self, resource, requests, rounds):
+        start = time.time()
+        for i in xrange(rounds):
+            for method, path in requests:
+                resource._get_callback(getRequest(method, path))
+        return rounds * len(requests) / (time.time() - start)
+
+    def test_lookups_per_second(self):
+        trie, linear = APIResource(), LinearAPIResource()
+        requests = []
+        for position, (method, path) in enumerate(self._routes()):
+            for r in (trie, linear):
+                r.register(method, '^'+ path +'$', position)
+                r.register('OPTIONS', '^'+ path +'$', position)
+            requests.append((method, path.replace('(?P<name>[^/]+)', 'x%d' % position)))
+
+        for method, path in requests:
+            self.assertEqual(trie._get_callback(getRequest(method, path)),
+                             linear._get_callback(getRequest(method, path)))
+
+        trie_rate = self._rate(trie, requests, 20)
+        linear_rate = self._rate(linear, requests, 20)
+        sys.stdout.write('\n%d routes: trie %d lookups/s, linear %d lookups/s (x%.1f)\n'
+                         % (len(trie._registry), trie_rate, linear_rate, trie_rate / linear_rate))
+
 
 class TestResource(Resource):
     isLeaf = True
@@ -189,6 +306,7 @@ def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(ut.makeSuite(DecoratorsTest))
     suite.addTest(ut.makeSuite(APIResourceTest))
+    suite.addTest(ut.makeSuite(RoutingBenchmark))
     suite.addTest(unittest.doctest.DocFileSuite(os.path.join('..', 'README.rst')))
     return suite
 
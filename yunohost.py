@@ -31,19 +31,53 @@ except ImportError:
     sys.stderr.write('apt-get install python-ldap\n')
     sys.exit(1)
 import ldap.modlist as modlist
-import yaml
+from ldap.filter import escape_filter_chars
+from ldap.controls import SimplePagedResultsControl, RequestControl
 import json
 import re
 import getpass
 import random
+import hashlib
+import hmac
+import time
+import cPickle
+import copy
 import string
 import argparse
 import gettext
 import getpass
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 if not __debug__:
     import traceback
 
 win = []
+# Per-thread execution state, used by the API worker threads
+context = threading.local()
+action_map_cache = '/var/cache/yunohost/action_map.pkl'
+daemon_socket = '/var/run/yunohost.sock'
+ldap_uri = 'ldap://localhost:389'
+# Rewritten by 'yunohost tools adminpw' and 'ldapinit', its change
+# invalidates the credentials and connections of LDAPPool in every process
+ldap_credentials_stamp = '/etc/smbldap-tools/smbldap_bind.conf'
+
+# Bounded LRU of compiled validation patterns
+validators = OrderedDict()
+validators_size = 256
+validators_stats = { 'hits': 0, 'misses': 0 }
+validators_lock = threading.Lock()
+
+# Read-through cache of searches under these bases, see search_cache_get()
+search_cache = OrderedDict()
+search_cache_size = 256
+search_cache_ttl = 30
+search_cache_bases = ['ou=domains,dc=yunohost,dc=org', 'ou=users,dc=yunohost,dc=org']
+search_cache_stats = { 'hits': 0, 'misses': 0, 'invalidations': 0 }
+search_cache_generation = [0]
+search_cache_lock = threading.Lock()
+# Controls supported by the LDAP server, read once from its root DSE
+server_controls = []
 
 def random_password(length=8):
     char_set = string.ascii_uppercase + string.digits + string.ascii_lowercase
@@ -103,11 +137,202 @@ def win_msg(astr):
         astr -- Win message to display
 
     """
-    global win
     if os.isatty(1):
         print('\n' + colorize(_("Success: "), 'green') + astr + '\n')
 
-    win.append(astr)
+    getattr(context, 'win', win).append(astr)
+
+
+def progress_msg(astr):
+    """
+    Report the progress of a long action
+
+    Written to stderr so that JSON results stay parsable, the API server
+    records it as a job message.
+
+    Keyword arguments:
+        astr -- Progress message to display
+
+    """
+    sys.stderr.write(astr + '\n')
+
+
+class LazyModule(object):
+    """
+    Module proxy importing the real module on first attribute access
+
+    Keyword arguments:
+        name    -- Name of the module to import
+        package -- Debian package providing the module, for error messages
+
+    """
+    def __init__(self, name, package=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_package'] = package
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            try:
+                __import__(self._name)
+            except ImportError:
+                message = _('YunoHost requires the library ') + self._name
+                if self._package:
+                    message = message + ' (apt-get install '+ self._package +')'
+                raise YunoHostError(1, message)
+            self.__dict__['_module'] = sys.modules[self._name]
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+
+def search_cache_get(key):
+    """
+    Get cached search entries
+
+    Entries are shared, callers must copy them before handing them out.
+
+    Keyword arguments:
+        key -- Search key built by YunoHostLDAP
+
+    Returns:
+        List of entries | None if not cached or expired
+
+    """
+    with search_cache_lock:
+        cached = search_cache.get(key)
+        if cached is None or cached[0] < time.time():
+            search_cache_stats['misses'] += 1
+            return None
+        search_cache_stats['hits'] += 1
+        search_cache[key] = search_cache.pop(key)
+        return cached[1]
+
+
+def search_cache_set(key, entries, generation):
+    """
+    Cache search entries, unless the cache was invalidated since the search began
+
+    Keyword arguments:
+        key -- Search key built by YunoHostLDAP
+        entries -- List of entries
+        generation -- Value of search_cache_generation when the search began
+
+    """
+    with search_cache_lock:
+        if generation != search_cache_generation[0]:
+            return
+        search_cache[key] = (time.time() + search_cache_ttl, entries)
+        while len(search_cache) > search_cache_size:
+            search_cache.popitem(last=False)
+
+
+def invalidate_search_cache(dn=None):
+    """
+    Drop the cached searches which may include an entry
+
+    Keyword arguments:
+        dn -- DN of the modified entry, everything is dropped if None
+
+    """
+    with search_cache_lock:
+        search_cache_generation[0] += 1
+        search_cache_stats['invalidations'] += 1
+        if dn is None:
+            search_cache.clear()
+            return
+        dn = dn.lower()
+        for key in search_cache.keys():
+            base = key[1].lower()
+            if dn.endswith(base) or base.endswith(dn):
+                del search_cache[key]
+
+
+def search_cache_info():
+    """
+    Get hit/miss counters of the LDAP search cache
+
+    Returns:
+        Dict
+
+    """
+    with search_cache_lock:
+        return dict(search_cache_stats, size=len(search_cache), maxsize=search_cache_size)
+
+
+def watch_changes(uri=ldap_uri):
+    """
+    Invalidate the LDAP search cache on syncrepl change notifications
+
+    Blocks while the connection lasts. Needs the python-ldap syncrepl
+    module, and the syncprov overlay on the server.
+
+    Keyword arguments:
+        uri -- URI of the LDAP server
+
+    """
+    from ldap.ldapobject import SimpleLDAPObject
+    from ldap.syncrepl import SyncreplConsumer
+
+    class Consumer(SimpleLDAPObject, SyncreplConsumer):
+        def syncrepl_get_cookie(self):
+            return None
+
+        def syncrepl_set_cookie(self, cookie):
+            pass
+
+        def syncrepl_entry(self, dn, attributes, uuid):
+            invalidate_search_cache(dn)
+
+        def syncrepl_delete(self, uuids):
+            invalidate_search_cache()
+
+        def syncrepl_present(self, uuids, refreshDeletes=False):
+            pass
+
+    conn = Consumer(uri)
+    conn.simple_bind_s()
+    msgid = conn.syncrepl_search(YunoHostLDAP.base, ldap.SCOPE_SUBTREE, mode='refreshAndPersist',
+                                 attrlist=['dn'])
+    while conn.syncrepl_poll(msgid=msgid, all=1):
+        pass
+
+
+def lazy_import(name, package=None):
+    """
+    Defer the import of a module until it is actually used
+
+    Keyword arguments:
+        name    -- Name of the module to import
+        package -- Debian package providing the module
+
+    Returns:
+        LazyModule
+
+    """
+    return LazyModule(name, package)
+
+
+yaml = lazy_import('yaml', 'python-yaml')
+yunohost_app = lazy_import('yunohost_app')
+
+
+def ssowat_refresh():
+    """
+    Regenerate the SSOwat configuration after users or domains changed
+
+    A failure is reported but doesn't fail the calling action, which is
+    already done.
+
+    """
+    try:
+        yunohost_app.app_ssowatconf(quiet=True)
+    except YunoHostError, error:
+        progress_msg(_("SSOwat configuration not updated: ") + error.message)
 
 
 def str_to_func(astr):
@@ -137,6 +362,75 @@ def str_to_func(astr):
         return func
 
 
+def get_validator(pattern):
+    """
+    Get a compiled pattern from the bounded LRU cache
+
+    Keyword arguments:
+        pattern -- Regex string, or an already compiled regex
+
+    Returns:
+        Compiled regex
+
+    """
+    if hasattr(pattern, 'match'):
+        return pattern
+
+    with validators_lock:
+        try:
+            validator = validators.pop(pattern)
+            validators_stats['hits'] += 1
+        except KeyError:
+            validator = re.compile(pattern)
+            validators_stats['misses'] += 1
+            if len(validators) >= validators_size:
+                validators.popitem(last=False)
+        validators[pattern] = validator
+
+    return validator
+
+
+def validate_cache_info():
+    """
+    Get hit/miss counters of the validators cache
+
+    Returns:
+        Dict
+
+    """
+    with validators_lock:
+        return {
+            'hits'   : validators_stats['hits'],
+            'misses' : validators_stats['misses'],
+            'size'   : len(validators),
+            'maxsize': validators_size
+        }
+
+
+def validate_many(pattern, values):
+    """
+    Validate strings with a pattern in one pass
+
+    Keyword arguments:
+        pattern -- Regex to match with the strings
+        values -- String or list of strings to check
+
+    Returns:
+        Boolean | YunoHostError listing every invalid string
+
+    """
+    if values is None:
+        return True
+    if isinstance(values, basestring):
+        values = [values]
+
+    match = get_validator(pattern).match
+    invalid = [string for string in values if not match(string)]
+    if invalid:
+        raise YunoHostError(22, _('Invalid attribute') + ' ' + ', '.join(invalid))
+    return True
+
+
 def validate(pattern, array):
     """
     Validate attributes with a pattern
@@ -149,16 +443,7 @@ def validate(pattern, array):
         Boolean | YunoHostError
 
     """
-    if array is None:
-        return True
-    if isinstance(array, str):
-        array = [array]
-    for string in array:
-        if re.match(pattern, string):
-            pass
-        else:
-            raise YunoHostError(22, _('Invalid attribute') + ' ' + string)
-        return True
+    return validate_many(pattern, array)
 
 def get_required_args(args, required_args, password=False):
     """
@@ -252,10 +537,15 @@ class YunoHostLDAP(Singleton):
     """ Specific LDAP functions for YunoHost """
     pwd = False
     connected = False
-    conn = ldap.initialize('ldap://localhost:389')
+    _conn = ldap.initialize(ldap_uri)
     base = 'dc=yunohost,dc=org'
     level = 0
 
+    @property
+    def conn(self):
+        """ Connection borrowed from an LDAPPool by this thread, or the shared one """
+        return getattr(context, 'ldap_conn', None) or self._conn
+
     def __enter__(self):
         return self
 
@@ -266,6 +556,10 @@ class YunoHostLDAP(Singleton):
         Initialize to localhost, base yunohost.org, prompt for password
 
         """
+        # Already bound by LDAPPool.connection()
+        if getattr(context, 'ldap_conn', None) is not None:
+            return
+
         if anonymous:
            self.conn.simple_bind_s()
            self.connected = True
@@ -302,6 +596,8 @@ class YunoHostLDAP(Singleton):
         self.level = self.level+1
 
     def __exit__(self, type, value, traceback):
+        if getattr(context, 'ldap_conn', None) is not None:
+            return
         self.level = self.level-1
         if self.level == 0:
             try: self.disconnect()
@@ -318,44 +614,158 @@ class YunoHostLDAP(Singleton):
         try:
             self.connected = False
             self.pwd = False
-            self.conn.unbind_s()
+            self._conn.unbind_s()
         except:
             raise YunoHostError(169, _('An error occured during disconnection'))
         else:
             return True
+        finally:
+            # An unbound connection can't be bound again
+            YunoHostLDAP._conn = ldap.initialize(ldap_uri)
 
 
-    def search(self, base=None, filter='(objectClass=*)', attrs=['dn']):
+    def search(self, base=None, filter='(objectClass=*)', attrs=['dn'], scope=ldap.SCOPE_SUBTREE, sizelimit=0, cache=True):
         """
         Search in LDAP base
 
         Keyword arguments:
-            base    -- Base to search into
-            filter  -- LDAP filter
-            attrs   -- Array of attributes to fetch
+            base      -- Base to search into
+            filter    -- LDAP filter
+            attrs     -- Array of attributes to fetch
+            scope     -- LDAP search scope
+            sizelimit -- Maximum number of entries to fetch (0 for no limit)
+            cache     -- Use the search cache for domains and users
 
         Returns:
             Boolean | Dict
 
+        """
+        result_list = list(self.search_iter(base, filter, attrs, scope, sizelimit=sizelimit, cache=cache))
+        if result_list:
+            return result_list
+        else:
+            return False
+
+
+    def search_iter(self, base=None, filter='(objectClass=*)', attrs=['dn'], scope=ldap.SCOPE_SUBTREE, page_size=100, sizelimit=0, cache=True, sort=None):
+        """
+        Search in LDAP base, yielding entries as the server returns them
+
+        Entries are fetched by pages of page_size with the Simple Paged
+        Results control. Stopping the iteration (or closing the generator)
+        abandons the running search, so the remaining entries are neither
+        sent by the server nor buffered.
+
+        Entries are sorted by the server when it supports the Server Side
+        Sorting control (sssvlv overlay of slapd), else they are all fetched
+        and sorted here.
+
+        Complete searches under search_cache_bases are cached for
+        search_cache_ttl seconds, add(), remove() and update() drop them.
+
+        Keyword arguments:
+            base      -- Base to search into
+            filter    -- LDAP filter
+            attrs     -- Array of attributes to fetch
+            scope     -- LDAP search scope
+            page_size -- Number of entries the server sends per page
+            sizelimit -- Maximum number of entries to fetch (0 for no limit)
+            cache     -- Use the search cache for domains and users
+            sort      -- Attributes to sort by, prefixed with '-' for reverse
+                         order. They must be fetched.
+
+        Returns:
+            Generator of Dict
+
         """
         if not base:
             base = self.base
 
+        key = None
+        if cache and any(base.lower().endswith(b) for b in search_cache_bases):
+            # Anonymous and admin binds don't see the same attributes
+            admin = getattr(context, 'ldap_conn', None) is not None or bool(self.pwd)
+            key = (admin, base, filter, tuple(attrs) if attrs is not None else None, scope, sizelimit,
+                   tuple(sort) if sort else None)
+            cached = search_cache_get(key)
+            if cached is not None:
+                for entry in cached:
+                    yield copy.deepcopy(entry)
+                return
+
+        generation = search_cache_generation[0]
+        entries = []
+        if not sort:
+            pages = self._search_pages(base, filter, attrs, scope, page_size, sizelimit)
+        elif self.supports_control(ServerSortControl.controlType):
+            pages = self._search_pages(base, filter, attrs, scope, page_size, sizelimit,
+                                       [ServerSortControl(sort)])
+        else:
+            pages = _sort_entries(self._search_pages(base, filter, attrs, scope, 500, 0), sort)
+            if sizelimit:
+                pages = pages[:sizelimit]
+        for entry in pages:
+            if key is not None:
+                entries.append(copy.deepcopy(entry))
+            yield entry
+        if key is not None:
+            search_cache_set(key, entries, generation)
+
+
+    def _search_pages(self, base, filter, attrs, scope, page_size, sizelimit, controls=[]):
+        control = SimplePagedResultsControl(True, size=page_size, cookie='')
+        msgid = None
         try:
-            result = self.conn.search_s(base, ldap.SCOPE_SUBTREE, filter, attrs)
-        except:
+            while True:
+                msgid = self.conn.search_ext(base, scope, filter, attrs,
+                                             serverctrls=controls + [control], sizelimit=sizelimit)
+                while True:
+                    rtype, rdata, rmsgid, serverctrls = self.conn.result3(msgid, all=0)
+                    if rtype == ldap.RES_SEARCH_RESULT:
+                        break
+                    for dn, entry in rdata:
+                        # Skip search continuation references
+                        if rtype != ldap.RES_SEARCH_ENTRY:
+                            continue
+                        if attrs != None:
+                            if 'dn' in attrs:
+                                entry['dn'] = [dn]
+                        yield entry
+                msgid = None
+
+                cookies = [c.cookie for c in serverctrls
+                           if c.controlType == SimplePagedResultsControl.controlType]
+                if not cookies or not cookies[0]:
+                    break
+                control.cookie = cookies[0]
+        except ldap.SIZELIMIT_EXCEEDED:
+            msgid = None
+        except ldap.LDAPError:
             raise YunoHostError(169, _('An error occured during LDAP search'))
+        finally:
+            if msgid is not None:
+                try: self.conn.abandon(msgid)
+                except ldap.LDAPError: pass
 
-        if result:
-            result_list = []
-            for dn, entry in result:
-                if attrs != None:
-                    if 'dn' in attrs:
-                        entry['dn'] = [dn]
-                result_list.append(entry)
-            return result_list
-        else:
-            return False
+
+    def supports_control(self, oid):
+        """
+        Check if the LDAP server supports a control
+
+        Keyword arguments:
+            oid -- Control type
+
+        Returns:
+            Boolean
+
+        """
+        if not server_controls:
+            try:
+                result = self.conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['supportedControl'])
+            except ldap.LDAPError:
+                return False
+            server_controls.append(set(result[0][1].get('supportedControl', [])) if result else set())
+        return oid in server_controls[0]
 
 
     def add(self, rdn, attr_dict):
@@ -379,6 +789,41 @@ class YunoHostLDAP(Singleton):
             raise YunoHostError(169, _('An error occured during LDAP entry creation'))
         else:
             return True
+        finally:
+            invalidate_search_cache(dn)
+
+    def add_many(self, entries):
+        """
+        Add LDAP entries, sending all of them at once
+
+        Keyword arguments:
+            entries -- List of (rdn, attr_dict) tuples, see add()
+
+        Returns:
+            Boolean | YunoHostError listing the entries which couldn't be added
+
+        """
+        pending = []
+        failed = []
+        try:
+            for rdn, attr_dict in entries:
+                dn = rdn + ',' + self.base
+                pending.append((rdn, self.conn.add_ext(dn, modlist.addModlist(attr_dict))))
+
+            for rdn, msgid in pending:
+                try:
+                    self.conn.result3(msgid)
+                except ldap.LDAPError:
+                    failed.append(rdn)
+        except ldap.LDAPError:
+            raise YunoHostError(169, _('An error occured during LDAP entry creation'))
+        finally:
+            for rdn, msgid in pending:
+                invalidate_search_cache(rdn + ',' + self.base)
+
+        if failed:
+            raise YunoHostError(169, _('An error occured during LDAP entry creation') + ' : ' + ', '.join(failed))
+        return True
 
     def remove(self, rdn):
         """
@@ -398,24 +843,68 @@ class YunoHostLDAP(Singleton):
             raise YunoHostError(169, _('An error occured during LDAP entry deletion'))
         else:
             return True
+        finally:
+            invalidate_search_cache(dn)
 
 
-    def update(self, rdn, attr_dict, new_rdn=False):
+    def remove_many(self, rdns):
+        """
+        Remove LDAP entries, sending all the deletions at once
+
+        Keyword arguments:
+            rdns -- List of DN without domain
+
+        Returns:
+            Boolean | YunoHostError listing the entries which couldn't be removed
+
+        """
+        pending = []
+        failed = []
+        try:
+            for rdn in rdns:
+                pending.append((rdn, self.conn.delete_ext(rdn + ',' + self.base)))
+
+            for rdn, msgid in pending:
+                try:
+                    self.conn.result3(msgid)
+                except ldap.LDAPError:
+                    failed.append(rdn)
+        except ldap.LDAPError:
+            raise YunoHostError(169, _('An error occured during LDAP entry deletion'))
+        finally:
+            for rdn, msgid in pending:
+                invalidate_search_cache(rdn + ',' + self.base)
+
+        if failed:
+            raise YunoHostError(169, _('An error occured during LDAP entry deletion') + ' : ' + ', '.join(failed))
+        return True
+
+
+    def update(self, rdn, attr_dict, new_rdn=False, old_attr_dict=None):
         """
         Modify LDAP entry
 
+        The entry is read first to compute the changes, unless its current
+        values are given with old_attr_dict.
+
         Keyword arguments:
-            rdn         -- DN without domain
-            attr_dict   -- Dictionnary of attributes/values to add
-            new_rdn     -- New RDN for modification
+            rdn           -- DN without domain
+            attr_dict     -- Dictionnary of attributes/values to add
+            new_rdn       -- New RDN for modification
+            old_attr_dict -- Dictionnary of current attributes/values of the entry
 
         Returns:
             Boolean | YunoHostError
 
         """
         dn = rdn + ',' + self.base
-        actual_entry = self.search(base=dn, attrs=None)
-        ldif = modlist.modifyModlist(actual_entry[0], attr_dict, ignore_oldexistent=1)
+        if old_attr_dict is None:
+            actual_entry = self.search(base=dn, attrs=None, cache=False)
+            ldif = modlist.modifyModlist(actual_entry[0], attr_dict, ignore_oldexistent=1)
+        else:
+            ldif = _modify_modlist(old_attr_dict, attr_dict)
+            if not ldif and not new_rdn:
+                return True
 
         try:
             if new_rdn:
@@ -427,31 +916,514 @@ class YunoHostLDAP(Singleton):
             raise YunoHostError(169, _('An error occured during LDAP entry update'))
         else:
             return True
+        finally:
+            invalidate_search_cache(rdn + ',' + self.base)
+            if new_rdn:
+                invalidate_search_cache(new_rdn + ',' + self.base)
 
 
-    def validate_uniqueness(self, value_dict):
+    def update_many(self, updates):
+        """
+        Modify LDAP entries without reading them, sending all the changes at once
+
+        Keyword arguments:
+            updates -- List of (rdn, attr_dict, old_attr_dict) tuples, see update().
+                       The attributes are replaced if old_attr_dict is None
+
+        Returns:
+            Boolean | YunoHostError
+
+        """
+        pending = []
+        try:
+            for rdn, attr_dict, old_attr_dict in updates:
+                ldif = _modify_modlist(old_attr_dict or {}, attr_dict)
+                if ldif:
+                    dn = rdn + ',' + self.base
+                    pending.append((dn, self.conn.modify_ext(dn, ldif)))
+
+            failed = []
+            for dn, msgid in pending:
+                try:
+                    self.conn.result3(msgid)
+                except ldap.LDAPError:
+                    failed.append(dn)
+        except ldap.LDAPError:
+            raise YunoHostError(169, _('An error occured during LDAP entry update'))
+        finally:
+            for dn, msgid in pending:
+                invalidate_search_cache(dn)
+
+        if failed:
+            raise YunoHostError(169, _('An error occured during LDAP entry update') + ' : ' + ', '.join(failed))
+        return True
+
+
+    def validate_uniqueness(self, value_dict, base=None):
         """
         Check uniqueness of values
 
+        Every value is checked with a single search, and all the existing
+        ones are reported in the error.
+
         Keyword arguments:
-            value_dict -- Dictionnary of attributes/values to check
+            value_dict -- Dictionnary of attributes/values (or lists of values) to check
+            base       -- Base to search into
 
         Returns:
             Boolean | YunoHostError
 
         """
+        values = []
         for attr, value in value_dict.items():
-            if not self.search(filter=attr + '=' + value):
-                continue
-            else:
-                raise YunoHostError(17, _('Attribute already exists') + ' "' + attr + '=' + value + '"')
+            if not isinstance(value, list):
+                value = [ value ]
+            values.extend((attr, v) for v in value)
+        if not values:
+            return True
+
+        filter = '(|'+ ''.join('('+ attr +'='+ escape_filter_chars(value) +')'
+                               for attr, value in values) +')'
+        # Only the checked attributes are fetched, to tell which values exist
+        result = self.search(base=base, filter=filter, attrs=list(value_dict), cache=False)
+        if not result:
+            return True
+
+        existing = set()
+        for entry in result:
+            for attr in value_dict:
+                existing.update((attr, v.lower()) for v in entry.get(attr, []))
+        conflicts = [attr +'='+ value for attr, value in values
+                     if (attr, value.lower()) in existing]
+        if not conflicts:
+            # Matched by a rule other than case-insensitive equality
+            conflicts = [attr +'='+ value for attr, value in values]
+        raise YunoHostError(17, _('Attribute already exists') + ' "' + '", "'.join(conflicts) + '"')
+
+
+class LDAPPool(object):
+    """
+    Pool of LDAP connections bound with an admin credential
+
+    Connections are kept per credential, so a connection is only handed
+    to a caller knowing the password it was bound with. Successfully bound
+    credentials are also remembered for credentials_ttl seconds, so that
+    verify() doesn't need to bind again. Both are dropped when the stamp
+    file is modified, e.g. by another process changing the password.
+
+    Keyword arguments:
+        size            -- Maximum number of idle connections kept per credential
+        idle_timeout    -- Seconds after which evict() closes an idle connection
+        check_after     -- Seconds of idleness after which a connection is
+                           checked before being reused
+        credentials_ttl -- Seconds a verified credential is trusted
+        uri             -- URI of the LDAP server
+        stamp           -- File modified when the admin password changes
+
+    """
+    def __init__(self, size=5, idle_timeout=300, check_after=10, credentials_ttl=60, uri=ldap_uri, stamp=ldap_credentials_stamp):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.credentials_ttl = credentials_ttl
+        self.uri = uri
+        self.stamp = stamp
+        self.idle = {}
+        self.verified = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.salt = os.urandom(16)
+        self.stats = { 'created': 0, 'reused': 0, 'discarded': 0, 'evicted': 0, 'verified': 0 }
+
+    def key(self, password):
+        """
+        Salted hash of a credential, the password itself is not kept
+
+        The key changes with clear() and with the modification of the
+        stamp file, so connections and credentials verified before a
+        password change are not used anymore.
+
+        """
+        return (self._generation(), hmac.new(self.salt, password, hashlib.sha256).hexdigest())
+
+    def is_verified(self, password):
+        """
+        Check if a password was verified recently, without binding
+
+        Keyword arguments:
+            password -- Admin password
+
+        Returns:
+            Boolean
+
+        """
+        key = self.key(password)
+        with self.lock:
+            if self.verified.get(key, 0) > time.time():
+                self.stats['verified'] += 1
+                return True
+        return False
+
+    def verify(self, password):
+        """
+        Check an admin password, binding only if it wasn't verified recently
+
+        Keyword arguments:
+            password -- Admin password
+
+        Returns:
+            True | YunoHostError
+
+        """
+        if self.is_verified(password):
+            return True
+
+        # A pooled connection only proves the password was right when it
+        # was bound, so bind again
+        key = self.key(password)
+        self.release(key, self._bind(password))
+        with self.lock:
+            now = time.time()
+            for k, expiry in self.verified.items():
+                if expiry <= now:
+                    del self.verified[k]
+            self.verified[key] = now + self.credentials_ttl
         return True
 
+    def acquire(self, password):
+        """
+        Borrow a connection bound with a password
+
+        Idle connections are reused without binding again, use verify()
+        to authenticate a password.
+
+        Keyword arguments:
+            password -- Admin password
+
+        Returns:
+            Tuple of the credential key and the connection | YunoHostError
+
+        """
+        key = self.key(password)
+        while True:
+            with self.lock:
+                if not self.idle.get(key):
+                    break
+                conn, last_used = self.idle[key].pop()
+
+            if time.time() - last_used < self.check_after:
+                self._count('reused')
+                return key, conn
+            try:
+                conn.whoami_s()
+            except ldap.LDAPError:
+                self._count('discarded')
+                self._close(conn)
+            else:
+                self._count('reused')
+                return key, conn
+
+        return key, self._bind(password)
+
+    def release(self, key, conn, discard=False):
+        """
+        Give back a borrowed connection
+
+        Keyword arguments:
+            key     -- Credential key returned by acquire()
+            conn    -- Connection returned by acquire()
+            discard -- Close the connection instead of keeping it
+
+        """
+        with self.lock:
+            if not discard and key[0] == self._generation():
+                idle = self.idle.setdefault(key, [])
+                if len(idle) < self.size:
+                    idle.append((conn, time.time()))
+                    return
+            self.stats['discarded'] += 1
+        self._close(conn)
+
+    @contextmanager
+    def connection(self, password):
+        """
+        Bind YunoHostLDAP to a pooled connection in the current thread
+
+        Keyword arguments:
+            password -- Admin password
+
+        """
+        key, conn = self.acquire(password)
+        previous = getattr(context, 'ldap_conn', None)
+        context.ldap_conn = conn
+        discard = False
+        try:
+            yield conn
+        except ldap.SERVER_DOWN:
+            discard = True
+            raise
+        finally:
+            context.ldap_conn = previous
+            self.release(key, conn, discard)
+
+    def evict(self):
+        """
+        Close the connections idle for more than idle_timeout seconds
+
+        Returns:
+            Number of closed connections
+
+        """
+        expired = []
+        limit = time.time() - self.idle_timeout
+        with self.lock:
+            for key, idle in self.idle.items():
+                expired.extend(conn for conn, last_used in idle if last_used < limit)
+                idle[:] = [(conn, last_used) for conn, last_used in idle if last_used >= limit]
+                if not idle:
+                    del self.idle[key]
+            self.stats['evicted'] += len(expired)
+        for conn in expired:
+            self._close(conn)
+        return len(expired)
+
+    def clear(self):
+        """ Forget every credential and connection, e.g. when the admin password changes """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+            self.verified = {}
+            self.generation += 1
+        for connections in idle.values():
+            for conn, last_used in connections:
+                self._close(conn)
+
+    def info(self):
+        """
+        Returns:
+            Dictionnary of pool statistics
+
+        """
+        with self.lock:
+            idle = sum(len(connections) for connections in self.idle.values())
+            credentials = len(self.verified)
+            stats = dict(self.stats)
+        return dict(stats, idle=idle, size=self.size, credentials=credentials)
+
+    def _generation(self):
+        try:
+            stamp = os.stat(self.stamp).st_mtime
+        except OSError:
+            stamp = 0
+        return (self.generation, stamp)
+
+    def _bind(self, password):
+        """
+        Open a new connection bound with a password
+
+        Keyword arguments:
+            password -- Admin password
+
+        Returns:
+            Connection | YunoHostError
+
+        """
+        conn = ldap.initialize(self.uri)
+        try:
+            conn.simple_bind_s('cn=admin,' + YunoHostLDAP.base, password)
+        except ldap.INVALID_CREDENTIALS:
+            raise YunoHostError(13, _('Invalid credentials'))
+        except ldap.LDAPError:
+            raise YunoHostError(111, _('Unable to connect to LDAP server'))
+        self._count('created')
+        return conn
+
+    def _count(self, stat):
+        """ Increment a statistic, threads share them """
+        with self.lock:
+            self.stats[stat] += 1
+
+    def _close(self, conn):
+        try: conn.unbind_s()
+        except ldap.LDAPError: pass
+
+
+class ServerSortControl(RequestControl):
+    """
+    Server Side Sorting request control (RFC 2891), not provided by
+    python-ldap. It is not critical, so servers without it return
+    unsorted entries.
+
+    Keyword arguments:
+        keys -- Attributes to sort by, prefixed with '-' for reverse order
+
+    """
+    controlType = '1.2.840.113556.1.4.473'
+
+    def __init__(self, keys, criticality=False):
+        RequestControl.__init__(self, self.controlType, criticality)
+        self.keys = keys
+
+    def encodeControlValue(self):
+        # SEQUENCE OF SEQUENCE { attributeType OCTET STRING, reverseOrder [1] BOOLEAN }
+        sort_keys = ''
+        for key in self.keys:
+            value = _ber('\x04', key.lstrip('-'))
+            if key.startswith('-'):
+                value += '\x81\x01\xff'
+            sort_keys += _ber('\x30', value)
+        return _ber('\x30', sort_keys)
+
+
+def _ber(tag, value):
+    """ Encode a BER element with its definite length """
+    length = len(value)
+    if length < 0x80:
+        return tag + chr(length) + value
+    encoded = ''
+    while length:
+        encoded = chr(length & 0xff) + encoded
+        length >>= 8
+    return tag + chr(0x80 | len(encoded)) + encoded + value
+
+
+def _sort_entries(entries, keys):
+    """
+    Sort LDAP entries like the server would for ServerSortControl,
+    numbers being compared as integers
+
+    Keyword arguments:
+        entries -- Iterable of entries
+        keys    -- Attributes to sort by, prefixed with '-' for reverse order
+
+    Returns:
+        List of entries
+
+    """
+    def sort_value(entry, attr):
+        values = entry.get(attr) or ['']
+        return int(values[0]) if values[0].isdigit() else values[0].lower()
+
+    entries = list(entries)
+    # Sort by the last key first, sorts are stable
+    for key in reversed(keys):
+        attr = key.lstrip('-')
+        entries.sort(key=lambda entry: sort_value(entry, attr), reverse=key.startswith('-'))
+    return entries
+
+
+def _modify_modlist(old_attr_dict, attr_dict):
+    """
+    Build the modifications turning known values into new ones
+
+    Values appended to the end of an attribute are added, removed values are
+    deleted, and any other change replaces the attribute, which keeps the
+    order of values (e.g. the main mail address first). Attributes missing
+    from old_attr_dict are replaced.
+
+    Keyword arguments:
+        old_attr_dict -- Dictionnary of current attributes/values
+        attr_dict     -- Dictionnary of new attributes/values
+
+    Returns:
+        List of (operation, attribute, values) modifications
+
+    """
+    ldif = []
+    for attr, new in attr_dict.items():
+        if new is None:
+            new = []
+        elif not isinstance(new, list):
+            new = [ new ]
+        if attr not in old_attr_dict:
+            ldif.append((ldap.MOD_REPLACE, attr, new or None))
+            continue
+
+        old = old_attr_dict[attr]
+        if not isinstance(old, list):
+            old = [ old ]
+        if old == new:
+            continue
+        if not new:
+            ldif.append((ldap.MOD_DELETE, attr, None))
+        elif not old or new[:len(old)] == old:
+            ldif.append((ldap.MOD_ADD, attr, new[len(old):]))
+        elif [v for v in old if v in new] == new:
+            ldif.append((ldap.MOD_DELETE, attr, [v for v in old if v not in new]))
+        else:
+            ldif.append((ldap.MOD_REPLACE, attr, new))
+    return ldif
+
+
+# Bound admin connections of the API server and daemon
+ldap_pool = LDAPPool(size=10)
+
+
+def load_action_map(path='action_map.yml', cache_path=None):
+    """
+    Load the action map from its compiled cache or from the YAML file
+
+    The YAML file stays the source of truth: the cache is keyed on its
+    path, mtime and MD5 hash, and is rebuilt as soon as the file changes.
+
+    Keyword arguments:
+        path -- Path of the YAML action map
+        cache_path -- Path of the compiled cache (default action_map_cache)
+
+    Returns:
+        Dict
+
+    """
+    if cache_path is None:
+        cache_path = action_map_cache
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+
+    # Fast path: same file, same mtime
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = cPickle.load(f)
+        if cache['path'] == path and cache['mtime'] == mtime:
+            return cache['action_map']
+    except Exception:
+        cache = None
+
+    with open(path) as f:
+        content = f.read()
+    digest = hashlib.md5(content).hexdigest()
+
+    # The file was touched but not modified, keep the compiled map
+    if cache and cache['path'] == path and cache['hash'] == digest:
+        action_map = cache['action_map']
+    else:
+        action_map = yaml.load(content)
+
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_path +'.tmp', 'wb') as f:
+            cPickle.dump({
+                'path': path,
+                'mtime': mtime,
+                'hash': digest,
+                'action_map': action_map
+            }, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(cache_path +'.tmp', cache_path)
+    except (IOError, OSError):
+        # Cache is an optimization only (e.g. not writable by this user)
+        pass
+
+    return action_map
+
 
 def parse_dict(action_map):
     """
     Turn action dictionnary to parser, subparsers and arguments
 
+    Only the parser of the category/action named in sys.argv is built,
+    and only its module is imported. The whole tree is built when help
+    is requested or when sys.argv doesn't name a known action.
+
     Keyword arguments:
         action_map -- Multi-level dictionnary of categories/actions/arguments list
 
@@ -477,20 +1449,26 @@ def parse_dict(action_map):
 
     del action_map['general_arguments']
 
+    # Build only the requested action parser unless help is needed
+    lazy = '-h' not in sys.argv and '--help' not in sys.argv \
+           and len(sys.argv) > 2 and sys.argv[1] in action_map \
+           and sys.argv[2] in action_map[sys.argv[1]].get('actions', {})
+
     # Split categories into subparsers
     for category, category_params in action_map.items():
+        if lazy and category != sys.argv[1]: continue
         if 'category_help' not in category_params: category_params['category_help'] = ''
         subparsers_category[category] = subparsers.add_parser(category, help=category_params['category_help'])
         subparsers_action[category] = subparsers_category[category].add_subparsers()
         # Split actions
         if 'actions' in category_params:
             for action, action_params in category_params['actions'].items():
+                if lazy and action != sys.argv[2]: continue
                 if 'action_help' not in action_params: action_params['action_help'] = ''
                 parsers[category + '_' + action] = subparsers_action[category].add_parser(action, help=action_params['action_help'])
-                # Set the action s related function
+                # Set the action s related function, imported once parsed
                 parsers[category + '_' + action].set_defaults(
-                    func=str_to_func('yunohost_' + category + '.'
-                                     + category + '_' + action))
+                    func='yunohost_' + category + '.' + category + '_' + action)
                 # Add arguments
                 if 'arguments' in action_params:
                     for arg_name, arg_params in action_params['arguments'].items():
@@ -554,4 +1532,6 @@ def parse_dict(action_map):
     for key, value in patterns.items():
         validate(value, args_dict[key])
 
+    args.func = str_to_func(args.func)
+
     return args
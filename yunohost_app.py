@@ -724,10 +724,12 @@ def app_initdb(user, password=None, db=None, sql=None):
         win_msg(_("Database initiliazed"))
 
 
-def app_ssowatconf():
+def app_ssowatconf(quiet=False):
     """
     Regenerate SSOwat configuration file
 
+    Keyword argument:
+        quiet -- Don't display a success message
 
     """
 
@@ -781,7 +783,8 @@ def app_ssowatconf():
     with open('/etc/ssowat/conf.json', 'wb') as f:
         json.dump(conf_dict, f)
 
-    win_msg(_('SSOwat configuration generated'))
+    if not quiet:
+        win_msg(_('SSOwat configuration generated'))
 
 
 def _extract_app_from_file(path, remove=False):
@@ -25,12 +25,57 @@
 """
 import os
 import sys
-import datetime
 import re
 import shutil
 import json
+import string
+import datetime
+import ldap
+import grp
+import time
+import fcntl
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
 from urllib import urlopen
-from yunohost import YunoHostError, YunoHostLDAP, win_msg, colorize, validate, get_required_args
+from ldap.filter import escape_filter_chars
+from yunohost import YunoHostError, YunoHostLDAP, win_msg, colorize, validate, get_required_args, lazy_import, ssowat_refresh
+
+yunohost_app = lazy_import('yunohost_app')
+
+ssl_dir = '/usr/share/yunohost/yunohost-config/ssl/yunoCA'
+certs_dir = '/etc/yunohost/certs'
+# Number of certificates generated at once by domain_add()
+domain_workers = 4
+# 'openssl ca' updates the serial and index files of the CA
+ca_lock = threading.Lock()
+# Certificates signed with pyOpenSSL, when it is installed
+key_bits = 2048
+ca_digest = 'sha256'
+ca_cache = {}
+# Keys generated by domain_keypool(), taken by domain_add()
+key_pool_dir = '/var/cache/yunohost/keys'
+# Every zone has its own file, included by the index included by named.conf.local
+bind_conf = '/etc/bind/named.conf.local'
+bind_index = '/etc/bind/named.conf.yunohost'
+bind_zones_dir = '/etc/bind/yunohost'
+zones_dir = '/var/lib/bind'
+# Zone files, every host of zone_hosts (main_zone_hosts too for the main
+# domain) is given an A record
+zone_template = string.Template("""\
+$$TTL    38400
+${domain}.      IN   SOA   ns.${domain}. root.${domain}. ${serial} 10800 3600 604800 38400
+${domain}.      IN   NS    ns.${domain}.
+${domain}.      IN   MX    5 ${domain}.
+${domain}.      IN   TXT   "v=spf1 mx a -all"
+_xmpp-client._tcp.${domain}.  IN   SRV   0  5   5222  ${domain}.
+_xmpp-server._tcp.${domain}.  IN   SRV   0  5   5269  ${domain}.
+_jabber._tcp.${domain}.       IN   SRV   0  5   5269  ${domain}.
+""")
+zone_hosts = ['', 'ns.']
+main_zone_hosts = ['pubsub.', 'muc.', 'vjud.']
+# Details parsed from certificates and zones, kept while their file is unchanged
+file_info_cache = {}
 
 
 def domain_list(filter=None, limit=None, offset=None):
@@ -51,15 +96,22 @@ def domain_list(filter=None, limit=None, offset=None):
         else: limit = 1000
         if not filter: filter = 'virtualdomain=*'
 
-        result = yldap.search('ou=domains,dc=yunohost,dc=org', filter, attrs=['virtualdomain'])
+        # The server stops sending entries after the requested page,
+        # the search is abandoned as soon as the page is full
+        if limit > 0:
+            domains = yldap.search_iter('ou=domains,dc=yunohost,dc=org', filter, attrs=['virtualdomain'],
+                                        scope=ldap.SCOPE_ONELEVEL, page_size=min(offset + limit, 500),
+                                        sizelimit=offset + limit)
+            try:
+                for i, domain in enumerate(domains):
+                    if i >= offset:
+                        result_list.append(domain['virtualdomain'][0])
+                        if len(result_list) >= limit:
+                            break
+            finally:
+                domains.close()
 
-        if result and len(result) > (0 + offset) and limit > 0:
-            i = 0 + offset
-            for domain in result[i:]:
-                if i <= limit:
-                    result_list.append(domain['virtualdomain'][0])
-                    i += 1
-        else:
+        if not result_list:
             raise YunoHostError(167, _("No domain found"))
 
         return { 'Domains': result_list }
@@ -67,153 +119,169 @@ def domain_list(filter=None, limit=None, offset=None):
 
 def domain_add(domains, main=False):
     """
-    Create a custom domain
+    Create custom domains
+
+    Domains are provisioned by stages: certificates are generated in
+    parallel, then the configuration files are written, the domains are
+    added in LDAP at once, and every service is reloaded once. The files
+    written for the domains failing after validation are removed.
 
     Keyword argument:
         domains -- Domain name to add
+        main -- Add the records of the main domain to the zone
+
+    Returns:
+        Dict of created domains, failures, and duration of every stage in seconds
 
     """
     with YunoHostLDAP() as yldap:
-        attr_dict = { 'objectClass' : ['mailDomain', 'top'] }
-        ip = str(urlopen('http://ip.yunohost.org').read())
-        now = datetime.datetime.now()
-        timestamp = str(now.year) + str(now.month) + str(now.day)
-        result = []
+        failed = {}
+        timings = {}
+        start = time.time()
 
         if not isinstance(domains, list):
             domains = [ domains ]
 
+        # Existing domains are skipped, check the others in one LDAP search
+        try: existing = domain_list()['Domains']
+        except YunoHostError: existing = []
+        domains = [ domain for i, domain in enumerate(domains)
+                    if domain not in existing and domain not in domains[:i] ]
+        try:
+            yldap.validate_uniqueness({ 'virtualdomain' : domains }, base='ou=domains,dc=yunohost,dc=org')
+        except YunoHostError:
+            raise YunoHostError(17, _("Domain already created"))
+
+        for domain in domains:
+            if os.path.exists(zones_dir +'/'+ domain +'.zone'):
+                failed[domain] = _("Zone file already exists for ") + domain
+        domains = [ domain for domain in domains if domain not in failed ]
+
+        # Only fetched when there is a zone to write
+        if domains:
+            ip = str(urlopen('http://ip.yunohost.org').read()).strip()
+        # Files which are not removed if the domain can't be created
+        kept = dict((domain, set(path for path in _domain_paths(domain) if os.path.lexists(path)))
+                    for domain in domains)
+        timings['Validation'] = _elapsed(start)
+
+        # Certificates
+        start = time.time()
+        if domains:
+            pool = ThreadPool(min(domain_workers, len(domains)))
+            try:
+                for domain, error in pool.imap_unordered(_domain_certificate_job, domains):
+                    if error:
+                        failed[domain] = error
+            finally:
+                pool.close()
+        rollback = [ domain for domain in domains if domain in failed ]
+        domains = [ domain for domain in domains if domain not in failed ]
+        timings['Certificates'] = _elapsed(start)
+
+        # Zones, XMPP and Nginx configuration
+        start = time.time()
         for domain in domains:
             try:
-                if domain in domain_list()['Domains']: continue
-            except YunoHostError: pass
-            ssl_dir = '/usr/share/yunohost/yunohost-config/ssl/yunoCA'
-            ssl_domain_path  = '/etc/yunohost/certs/'+ domain
-            with open(ssl_dir +'/serial', 'r') as f:
-                serial = f.readline().rstrip()
-            try: os.listdir(ssl_domain_path)
-            except OSError: os.makedirs(ssl_domain_path)
-
-            command_list = [
-                'cp '+ ssl_dir +'/openssl.cnf '+ ssl_domain_path,
-                'sed -i "s/yunohost.org/' + domain + '/g" '+ ssl_domain_path +'/openssl.cnf',
-                'openssl req -new -config '+ ssl_domain_path +'/openssl.cnf -days 3650 -out '+ ssl_dir +'/certs/yunohost_csr.pem -keyout '+ ssl_dir +'/certs/yunohost_key.pem -nodes -batch',
-                'openssl ca -config '+ ssl_domain_path +'/openssl.cnf -days 3650 -in '+ ssl_dir +'/certs/yunohost_csr.pem -out '+ ssl_dir +'/certs/yunohost_crt.pem -batch',
-                'ln -s /etc/ssl/certs/ca-yunohost_crt.pem   '+ ssl_domain_path +'/ca.pem',
-                'cp '+ ssl_dir +'/certs/yunohost_key.pem    '+ ssl_domain_path +'/key.pem',
-                'cp '+ ssl_dir +'/newcerts/'+ serial +'.pem '+ ssl_domain_path +'/crt.pem',
-                'chmod 755 '+ ssl_domain_path,
-                'chmod 640 '+ ssl_domain_path +'/key.pem',
-                'chmod 640 '+ ssl_domain_path +'/crt.pem',
-                'chmod 600 '+ ssl_domain_path +'/openssl.cnf',
-                'chown root:metronome '+ ssl_domain_path +'/key.pem',
-                'chown root:metronome '+ ssl_domain_path +'/crt.pem'
-            ]
-
-            for command in command_list:
-                if os.system(command) != 0:
-                    raise YunoHostError(17, _("An error occurred during certificate generation"))
+                _domain_zone(domain, ip, main)
+                _bind_add(domain)
+                _domain_metronome(domain)
+                _domain_nginx(domain)
+            except (IOError, OSError) as e:
+                failed[domain] = _("An error occured during domain configuration") +' : '+ str(e)
+                rollback.append(domain)
+        domains = [ domain for domain in domains if domain not in failed ]
+        timings['Configuration'] = _elapsed(start)
 
+        start = time.time()
+        result = []
+        if domains:
             try:
-                yldap.validate_uniqueness({ 'virtualdomain' : domain })
+                yldap.add_many([ ('virtualdomain='+ domain +',ou=domains',
+                                  { 'objectClass': ['mailDomain', 'top'], 'virtualdomain': domain })
+                                 for domain in domains ])
+                result = domains
             except YunoHostError:
-                raise YunoHostError(17, _("Domain already created"))
+                # Find out which domains were added
+                added = yldap.search('ou=domains,dc=yunohost,dc=org',
+                                     '(|'+ ''.join('(virtualdomain='+ escape_filter_chars(domain) +')'
+                                                   for domain in domains) +')',
+                                     ['virtualdomain'], scope=ldap.SCOPE_ONELEVEL, cache=False) or []
+                added = set(domain['virtualdomain'][0] for domain in added)
+                result = [ domain for domain in domains if domain in added ]
+                for domain in domains:
+                    if domain not in added:
+                        failed[domain] = _("An error occured during domain creation")
+                        rollback.append(domain)
+        timings['LDAP'] = _elapsed(start)
 
+    for domain in rollback:
+        _domain_rollback(domain, kept[domain])
 
-            attr_dict['virtualdomain'] = domain
+    start = time.time()
+    if result:
+        _rndc('reconfig')
+        os.system('chown -R metronome: /var/lib/metronome/')
+        os.system('chown -R metronome: /etc/metronome/conf.d/')
+        os.system('service metronome restart')
+        os.system('service nginx reload')
+    timings['Services'] = _elapsed(start)
 
-            try:
-                with open('/var/lib/bind/'+ domain +'.zone') as f: pass
-            except IOError as e:
-                zone_lines = [
-                 '$TTL    38400',
-                 domain +'.      IN   SOA   ns.'+ domain +'. root.'+ domain +'. '+ timestamp +' 10800 3600 604800 38400',
-                 domain +'.      IN   NS    ns.'+ domain +'.',
-                 domain +'.      IN   A     '+ ip,
-                 domain +'.      IN   MX    5 '+ domain +'.',
-                 domain +'.      IN   TXT   "v=spf1 mx a -all"',
-                 'ns.'+ domain +'.   IN   A     '+ ip,
-                 '_xmpp-client._tcp.'+ domain +'.  IN   SRV   0  5   5222  '+ domain +'.',
-                 '_xmpp-server._tcp.'+ domain +'.  IN   SRV   0  5   5269  '+ domain +'.',
-                 '_jabber._tcp.'+ domain +'.       IN   SRV   0  5   5269  '+ domain +'.',
-                ]
-                if main:
-                    zone_lines.extend([
-                        'pubsub.'+ domain +'.   IN   A     '+ ip,
-                        'muc.'+ domain +'.      IN   A     '+ ip,
-                        'vjud.'+ domain +'.     IN   A     '+ ip
-                    ])
-                with open('/var/lib/bind/' + domain + '.zone', 'w') as zone:
-                    for line in zone_lines:
-                        zone.write(line + '\n')
-            else:
-                raise YunoHostError(17, _("Zone file already exists for ") + domain)
-
-            conf_lines = [
-                'zone "'+ domain +'" {',
-                '    type master;',
-                '    file "/var/lib/bind/'+ domain +'.zone";',
-                '    allow-transfer {',
-                '        127.0.0.1;',
-                '        localnets;',
-                '    };',
-                '};'
-            ]
-            with open('/etc/bind/named.conf.local', 'a') as conf:
-                for line in conf_lines:
-                   conf.write(line + '\n')
-
-            os.system('service bind9 reload')
-
-            # XMPP
-            try:
-                with open('/etc/metronome/conf.d/'+ domain +'.cfg.lua') as f: pass
-            except IOError as e:
-                conf_lines = [
-                    'VirtualHost "'+ domain +'"',
-                    '  ssl = {',
-                    '        key = "'+ ssl_domain_path +'/key.pem";',
-                    '        certificate = "'+ ssl_domain_path +'/crt.pem";',
-                    '  }',
-                    '  authentication = "ldap2"',
-                    '  ldap = {',
-                    '     hostname      = "localhost",',
-                    '     user = {',
-                    '       basedn        = "ou=users,dc=yunohost,dc=org",',
-                    '       filter        = "(&(objectClass=posixAccount)(mail=*@'+ domain +'))",',
-                    '       usernamefield = "mail",',
-                    '       namefield     = "cn",',
-                    '       },',
-                    '  }',
-                ]
-                with open('/etc/metronome/conf.d/' + domain + '.cfg.lua', 'w') as conf:
-                    for line in conf_lines:
-                        conf.write(line + '\n')
-
-            os.system('mkdir -p /var/lib/metronome/'+ domain.replace('.', '%2e') +'/pep')
-            os.system('chown -R metronome: /var/lib/metronome/')
-            os.system('chown -R metronome: /etc/metronome/conf.d/')
-            os.system('service metronome restart')
-
-
-            # Nginx
-            os.system('cp /usr/share/yunohost/yunohost-config/nginx/template.conf /etc/nginx/conf.d/'+ domain +'.conf')
-            os.system('mkdir /etc/nginx/conf.d/'+ domain +'.d/')
-            os.system('sed -i s/yunohost.org/'+ domain +'/g /etc/nginx/conf.d/'+ domain +'.conf')
-            os.system('service nginx reload')
-
-            if yldap.add('virtualdomain=' + domain + ',ou=domains', attr_dict):
-                result.append(domain)
-                continue
-            else:
-                raise YunoHostError(169, _("An error occured during domain creation"))
+    start = time.time()
+    if result:
+        ssowat_refresh()
+    timings['SSOwat'] = _elapsed(start)
 
+    if failed and not result:
+        raise YunoHostError(17, '\n'.join(failed[domain] for domain in sorted(failed)))
 
-        os.system('yunohost app ssowatconf > /dev/null 2>&1')
+    win_msg(_("Domain(s) successfully created"))
 
-        win_msg(_("Domain(s) successfully created"))
+    result = { 'Domains' : result, 'Timings' : timings }
+    if failed:
+        result['Failed'] = failed
+    return result
 
-        return { 'Domains' : result }
+
+def _domain_paths(domain):
+    """
+    Certificate and configuration files and directories written by
+    domain_add() for a domain
+
+    Keyword argument:
+        domain -- Domain name
+
+    Returns:
+        List of paths
+
+    """
+    return [ certs_dir +'/'+ domain,
+             zones_dir +'/'+ domain +'.zone',
+             '/var/lib/metronome/'+ domain.replace('.', '%2e'),
+             '/etc/metronome/conf.d/'+ domain +'.cfg.lua',
+             '/etc/nginx/conf.d/'+ domain +'.conf',
+             '/etc/nginx/conf.d/'+ domain +'.d' ]
+
+
+def _domain_rollback(domain, kept):
+    """
+    Remove the files written by domain_add() for a domain which could not
+    be created, except those which existed before
+
+    Keyword argument:
+        domain -- Domain name
+        kept -- Paths of _domain_paths() which existed before domain_add()
+
+    """
+    for path in _domain_paths(domain):
+        if path in kept:
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try: os.remove(path)
+            except OSError: pass
+    _bind_remove(domain)
 
 
 def domain_remove(domains):
@@ -234,31 +302,781 @@ def domain_remove(domains):
             if yldap.remove('virtualdomain=' + domain + ',ou=domains'):
                 try:
                     shutil.rmtree('/etc/yunohost/certs/'+ domain)
-                    os.remove('/var/lib/bind/'+ domain +'.zone')
+                    os.remove(zones_dir +'/'+ domain +'.zone')
                     shutil.rmtree('/var/lib/metronome/'+ domain.replace('.', '%2e'))
                     os.remove('/etc/metronome/conf.d/'+ domain +'.cfg.lua')
                 except:
                     pass
-                with open('/etc/bind/named.conf.local', 'r') as conf:
-                    conf_lines = conf.readlines()
-                with open('/etc/bind/named.conf.local', 'w') as conf:
-                    in_block = False
-                    for line in conf_lines:
-                        if re.search(r'^zone "'+ domain, line):
-                            in_block = True
-                        if in_block:
-                            if re.search(r'^};$', line):
-                                in_block = False
-                        else:
-                            conf.write(line)
+                # Journal of the dynamic updates
+                try: os.remove(zones_dir +'/'+ domain +'.zone.jnl')
+                except OSError: pass
+                _bind_remove(domain)
                 result.append(domain)
                 continue
             else:
                 raise YunoHostError(169, _("An error occured during domain deletion"))
 
-        os.system('yunohost app ssowatconf > /dev/null 2>&1')
+        if result:
+            _rndc('reconfig')
+
+        ssowat_refresh()
 
         win_msg(_("Domain(s) successfully deleted"))
 
         return { 'Domains' : result }
 
+
+def domain_info(domain):
+    """
+    Get domain informations
+
+    Keyword argument:
+        domain -- Domain name
+
+    Returns:
+        Dict of the certificate expiration, configuration files, apps and mail users
+
+    """
+    with YunoHostLDAP() as yldap:
+        if not yldap.search('ou=domains,dc=yunohost,dc=org', 'virtualdomain='+ escape_filter_chars(domain),
+                            ['virtualdomain'], scope=ldap.SCOPE_ONELEVEL):
+            raise YunoHostError(167, _("Domain not found : ") + domain)
+        users = yldap.search('ou=users,dc=yunohost,dc=org', 'mail=*@'+ escape_filter_chars(domain),
+                             ['uid'], scope=ldap.SCOPE_ONELEVEL) or []
+
+    return _domain_health(domain, _apps_map().get(domain, {}), [ user['uid'][0] for user in users ])
+
+
+def domain_status(domains=None):
+    """
+    Get the informations of many domains at once
+
+    Domains and mail users are fetched with one LDAP search each, and
+    certificates and zones are only parsed again once they changed.
+
+    Keyword argument:
+        domains -- Domains to check (default all)
+
+    Returns:
+        Dict of domain informations by domain, see domain_info()
+
+    """
+    with YunoHostLDAP() as yldap:
+        existing = [ entry['virtualdomain'][0] for entry in
+                     yldap.search_iter('ou=domains,dc=yunohost,dc=org', 'virtualdomain=*', ['virtualdomain'],
+                                       scope=ldap.SCOPE_ONELEVEL, page_size=500) ]
+        if domains:
+            if not isinstance(domains, list):
+                domains = [ domains ]
+            for domain in domains:
+                if domain not in existing:
+                    raise YunoHostError(167, _("Domain not found : ") + domain)
+        else:
+            domains = existing
+
+        users = {}
+        for user in yldap.search_iter('ou=users,dc=yunohost,dc=org', 'mail=*', ['uid', 'mail'],
+                                      scope=ldap.SCOPE_ONELEVEL, page_size=500):
+            for mail in user['mail']:
+                uids = users.setdefault(mail[mail.find('@')+1:], [])
+                if user['uid'][0] not in uids:
+                    uids.append(user['uid'][0])
+
+    apps = _apps_map()
+    return { 'Domains' : dict((domain, _domain_health(domain, apps.get(domain, {}), users.get(domain, [])))
+                              for domain in domains) }
+
+
+def domain_zonerefresh(ip=None):
+    """
+    Update the public IP address in the zones of all domains
+
+    Zones allowing local dynamic updates are updated through bind with a
+    single nsupdate. Other zones are rendered again if their address
+    changed, and bind reloads them once.
+
+    Keyword argument:
+        ip -- Public IP address (default fetched from ip.yunohost.org)
+
+    Returns:
+        Dict of updated domains
+
+    """
+    if not ip:
+        ip = str(urlopen('http://ip.yunohost.org').read()).strip()
+    try:
+        with open('/etc/yunohost/current_host') as f:
+            main_domain = f.readline().rstrip()
+    except IOError:
+        main_domain = None
+
+    dynamic = []
+    rendered = []
+    for domain, stanza in _bind_zones():
+        if 'update-policy local;' in stanza:
+            dynamic.append(domain)
+            continue
+        try:
+            with open(zones_dir +'/'+ domain +'.zone') as f:
+                zone = f.read()
+        except IOError:
+            continue
+        if re.search(r'^'+ re.escape(domain) +r'\.\s+IN\s+A\s+'+ re.escape(ip) +r'\s*$', zone, re.M):
+            continue
+        _domain_zone(domain, ip, domain == main_domain)
+        rendered.append(domain)
+
+    if dynamic:
+        lines = []
+        for domain in dynamic:
+            lines.append('zone '+ domain +'.')
+            for host in _zone_hosts(domain, domain == main_domain):
+                lines.append('update delete '+ host +' A')
+                lines.append('update add '+ host +' 38400 A '+ ip)
+            lines.append('send')
+        nsupdate = subprocess.Popen(['nsupdate', '-l'], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = nsupdate.communicate('\n'.join(lines) +'\n')[0]
+        if nsupdate.returncode != 0:
+            raise YunoHostError(1, _("An error occured during zone update") +' : '+ output.strip())
+    if rendered:
+        _rndc('reload')
+
+    win_msg(_("Zones successfully updated"))
+    return { 'Domains' : sorted(dynamic + rendered) }
+
+
+def domain_keypool(size=None):
+    """
+    Pre-generate private keys, so that domain add doesn't wait for RSA
+    key generation
+
+    Keyword argument:
+        size -- Number of keys to keep in the pool
+
+    Returns:
+        Dict of the number of keys in the pool
+
+    """
+    crypto = _crypto()
+    if crypto is None:
+        raise YunoHostError(1, _("pyOpenSSL is required, please install python-openssl"))
+    size = int(size) if size else 10
+
+    if not os.path.isdir(key_pool_dir):
+        os.makedirs(key_pool_dir, 0700)
+    count = len([ name for name in os.listdir(key_pool_dir) if name.endswith('.pem') ])
+    for i in range(count, size):
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, key_bits)
+        path = key_pool_dir +'/'+ '%d-%d-%d.pem' % (time.time() * 1000, os.getpid(), i)
+        _write_file(path, crypto.dump_privatekey(crypto.FILETYPE_PEM, key), 0600)
+
+    win_msg(_("Key pool successfully filled"))
+    return { 'Keys' : max(size, count) }
+
+
+def _domain_health(domain, apps, users):
+    """
+    Check the certificate and configuration files of a domain
+
+    Keyword argument:
+        domain -- Domain name
+        apps -- Dict of apps by path on the domain, see app_map()
+        users -- Usernames having a mail on the domain
+
+    Returns:
+        Dict of domain informations
+
+    """
+    expiration = _cached_file_info(certs_dir +'/'+ domain +'/crt.pem', _certificate_expiration)
+    if expiration is None:
+        certificate = _("Missing or invalid")
+    else:
+        certificate = {
+            'Expiration': expiration.strftime('%Y-%m-%d %H:%M:%S'),
+            'Days left' : (expiration - datetime.datetime.utcnow()).days
+        }
+
+    serial = _cached_file_info(zones_dir +'/'+ domain +'.zone', _zone_serial)
+    bind_conf = _cached_file_info(bind_zones_dir +'/'+ domain +'.conf', _bind_stanza_read)
+    return {
+        'Domain'     : domain,
+        'Certificate': certificate,
+        'DNS'        : { 'Zone': serial is not None, 'Serial': serial or 0, 'Bind': bool(bind_conf) },
+        'XMPP'       : os.path.exists('/etc/metronome/conf.d/'+ domain +'.cfg.lua'),
+        'Nginx'      : os.path.exists('/etc/nginx/conf.d/'+ domain +'.conf'),
+        'Apps'       : [ { 'Id': app['id'], 'Label': app['label'], 'Path': path }
+                         for path, app in sorted(apps.items()) ],
+        'Users'      : sorted(users)
+    }
+
+
+def _cached_file_info(path, parse):
+    """
+    Parse a file, the result being kept until the file changes
+
+    Keyword argument:
+        path -- File path
+        parse -- Function parsing the file from its path
+
+    Returns:
+        Result of parse, None if the file doesn't exist
+
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        file_info_cache.pop(path, None)
+        return None
+
+    key = (stat.st_mtime, stat.st_size, stat.st_ino)
+    cached = file_info_cache.get(path)
+    if cached is None or cached[0] != key:
+        cached = (key, parse(path))
+        file_info_cache[path] = cached
+    return cached[1]
+
+
+def _certificate_expiration(path):
+    """
+    Read the expiration date of a certificate, with pyOpenSSL if it is
+    installed, else with openssl
+
+    Keyword argument:
+        path -- Certificate path
+
+    Returns:
+        datetime in UTC, None if the certificate is invalid
+
+    """
+    crypto = _crypto()
+    try:
+        if crypto is not None:
+            with open(path) as f:
+                cert = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
+            return datetime.datetime.strptime(cert.get_notAfter(), '%Y%m%d%H%M%SZ')
+
+        process = subprocess.Popen(['openssl', 'x509', '-enddate', '-noout', '-in', path],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0].strip()
+        if process.returncode != 0 or not output.startswith('notAfter='):
+            return None
+        return datetime.datetime.strptime(output[9:], '%b %d %H:%M:%S %Y GMT')
+    except Exception:
+        return None
+
+
+def _apps_map():
+    """ Apps by path by domain, see app_map() """
+    try:
+        return yunohost_app.app_map(raw=True)
+    except (IOError, OSError):
+        return {}
+
+
+def _elapsed(start):
+    return round(time.time() - start, 3)
+
+
+def _domain_certificate_job(domain):
+    """
+    Generate the certificate of a domain, in a worker thread of domain_add()
+
+    Keyword argument:
+        domain -- Domain name
+
+    Returns:
+        Tuple of the domain and the error message, if any
+
+    """
+    try:
+        crypto = _crypto()
+        if crypto is None:
+            _domain_certificate(domain)
+        else:
+            _domain_certificate_native(domain, crypto)
+    except YunoHostError as e:
+        return domain, e.message
+    except Exception as e:
+        return domain, _("An error occurred during certificate generation") +' : '+ str(e)
+    return domain, None
+
+
+def _crypto():
+    """ pyOpenSSL crypto module, None if it is not installed """
+    try:
+        from OpenSSL import crypto
+    except ImportError:
+        return None
+    return crypto
+
+
+def _domain_certificate_native(domain, crypto):
+    """
+    Generate a key and a certificate signed by the local CA in process,
+    taking the key from the key pool if there is one
+
+    Keyword argument:
+        domain -- Domain name
+        crypto -- pyOpenSSL crypto module
+
+    """
+    ca_cert, ca_key = _load_ca(crypto)
+    key = _pooled_key(crypto)
+    if key is None:
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, key_bits)
+
+    cert = crypto.X509()
+    cert.set_version(2)
+    subject = cert.get_subject()
+    for name, value in ca_cert.get_subject().get_components():
+        if name not in ['CN', 'emailAddress']:
+            setattr(subject, name, value)
+    subject.CN = domain
+    cert.set_issuer(ca_cert.get_subject())
+    cert.set_pubkey(key)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3650 * 24 * 3600)
+    cert.add_extensions([
+        crypto.X509Extension('basicConstraints', False, 'CA:FALSE'),
+        crypto.X509Extension('subjectKeyIdentifier', False, 'hash', subject=cert),
+        crypto.X509Extension('authorityKeyIdentifier', False, 'keyid:always', issuer=ca_cert)
+    ])
+    crt = _ca_sign(crypto, cert, ca_key)
+
+    ssl_domain_path = certs_dir +'/'+ domain
+    if not os.path.isdir(ssl_domain_path):
+        os.makedirs(ssl_domain_path)
+    os.chmod(ssl_domain_path, 0755)
+    metronome_gid = grp.getgrnam('metronome').gr_gid
+    _write_file(ssl_domain_path +'/key.pem', crypto.dump_privatekey(crypto.FILETYPE_PEM, key), 0640, metronome_gid)
+    _write_file(ssl_domain_path +'/crt.pem', crt, 0640, metronome_gid)
+    if not os.path.lexists(ssl_domain_path +'/ca.pem'):
+        os.symlink('/etc/ssl/certs/ca-yunohost_crt.pem', ssl_domain_path +'/ca.pem')
+
+
+def _load_ca(crypto):
+    """
+    Load the certificate and key of the local CA, kept until they change
+
+    Keyword argument:
+        crypto -- pyOpenSSL crypto module
+
+    Returns:
+        Tuple of X509 and PKey
+
+    """
+    cert_path = ssl_dir +'/ca/cacert.pem'
+    key_path = ssl_dir +'/ca/cakey.pem'
+    mtimes = (os.path.getmtime(cert_path), os.path.getmtime(key_path))
+    if ca_cache.get('mtimes') != mtimes:
+        with open(cert_path) as f:
+            cert = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
+        with open(key_path) as f:
+            key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
+        ca_cache.update({ 'mtimes': mtimes, 'ca': (cert, key) })
+    return ca_cache['ca']
+
+
+def _ca_sign(crypto, cert, ca_key):
+    """
+    Sign a certificate with the next serial of the CA, and record it in
+    the CA index and new certificates like 'openssl ca' does
+
+    The serial file is locked, so other processes signing with this
+    function never get the same serial.
+
+    Keyword argument:
+        crypto -- pyOpenSSL crypto module
+        cert -- X509 to sign
+        ca_key -- PKey of the CA
+
+    Returns:
+        Signed certificate as PEM
+
+    """
+    with ca_lock:
+        with open(ssl_dir +'/serial', 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                serial = int(f.read().strip(), 16)
+                f.seek(0)
+                f.truncate()
+                f.write(_hex_serial(serial + 1) +'\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+                cert.set_serial_number(serial)
+                cert.sign(ca_key, ca_digest)
+                crt = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+                with open(ssl_dir +'/newcerts/'+ _hex_serial(serial) +'.pem', 'w') as new_cert:
+                    new_cert.write(crt)
+                subject = ''.join('/'+ name +'='+ value for name, value in cert.get_subject().get_components())
+                with open(ssl_dir +'/index.txt', 'a') as index:
+                    index.write('V\t'+ cert.get_notAfter()[2:] +'\t\t'+ _hex_serial(serial) +'\tunknown\t'+ subject +'\n')
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    return crt
+
+
+def _hex_serial(serial):
+    """ Serial as written by openssl: uppercase hexadecimal with an even number of digits """
+    serial = '%X' % serial
+    return '0'* (len(serial) % 2) + serial
+
+
+def _pooled_key(crypto):
+    """
+    Take a key from the key pool
+
+    Keyword argument:
+        crypto -- pyOpenSSL crypto module
+
+    Returns:
+        PKey, None if the pool is empty
+
+    """
+    try:
+        names = sorted(name for name in os.listdir(key_pool_dir) if name.endswith('.pem'))
+    except OSError:
+        return None
+
+    for name in names:
+        # Renaming fails if another thread or process took the key first
+        taken = key_pool_dir +'/'+ name[:-4] +'.%d-%d' % (os.getpid(), threading.current_thread().ident)
+        try:
+            os.rename(key_pool_dir +'/'+ name, taken)
+        except OSError:
+            continue
+        try:
+            with open(taken) as f:
+                return crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
+        finally:
+            os.remove(taken)
+    return None
+
+
+def _write_file(path, content, mode, gid=None):
+    """
+    Write a file readable only once its permissions are set, replacing
+    the former one atomically
+
+    Keyword argument:
+        path -- File path
+        content -- File content
+        mode -- Permissions
+        gid -- Group owning the file, owner is root
+
+    """
+    fd = os.open(path +'.new', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.chmod(path +'.new', mode)
+    if gid is not None:
+        os.chown(path +'.new', 0, gid)
+    os.rename(path +'.new', path)
+
+
+def _domain_certificate(domain):
+    """
+    Generate a key and a certificate signed by the local CA with the
+    openssl command, when pyOpenSSL is not installed
+
+    Keys are generated concurrently, signatures are serialized as
+    'openssl ca' updates the serial and index files of the CA.
+
+    Keyword argument:
+        domain -- Domain name
+
+    """
+    ssl_domain_path = certs_dir +'/'+ domain
+    if not os.path.isdir(ssl_domain_path):
+        os.makedirs(ssl_domain_path)
+
+    with open(ssl_dir +'/openssl.cnf') as f:
+        conf = f.read().replace('yunohost.org', domain)
+    with open(ssl_domain_path +'/openssl.cnf', 'w') as f:
+        f.write(conf)
+    os.chmod(ssl_domain_path +'/openssl.cnf', 0600)
+
+    conf = ssl_domain_path +'/openssl.cnf'
+    csr = ssl_domain_path +'/csr.pem'
+    _openssl(domain, ['req', '-new', '-config', conf, '-days', '3650', '-out', csr,
+                      '-keyout', ssl_domain_path +'/key.pem', '-nodes', '-batch'])
+    try:
+        with ca_lock:
+            _openssl(domain, ['ca', '-config', conf, '-days', '3650', '-in', csr,
+                              '-out', ssl_domain_path +'/crt.pem', '-batch'])
+    finally:
+        os.remove(csr)
+
+    if not os.path.lexists(ssl_domain_path +'/ca.pem'):
+        os.symlink('/etc/ssl/certs/ca-yunohost_crt.pem', ssl_domain_path +'/ca.pem')
+    metronome_gid = grp.getgrnam('metronome').gr_gid
+    os.chmod(ssl_domain_path, 0755)
+    for name in ['key.pem', 'crt.pem']:
+        os.chmod(ssl_domain_path +'/'+ name, 0640)
+        os.chown(ssl_domain_path +'/'+ name, 0, metronome_gid)
+
+
+def _openssl(domain, args):
+    """
+    Run openssl, its output is kept for the error message
+
+    Keyword argument:
+        domain -- Domain name the command is run for
+        args -- Arguments of openssl
+
+    """
+    process = subprocess.Popen(['openssl'] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise YunoHostError(17, _("An error occurred during certificate generation") +' ('+ domain +') : '+ output.strip())
+
+
+def _domain_zone(domain, ip, main=False):
+    """
+    Render the zone file of a domain from zone_template, with a serial
+    greater than the one of the former file
+
+    Keyword argument:
+        domain -- Domain name
+        ip -- Public IP address
+        main -- Add the records of the main domain
+
+    """
+    zone_path = zones_dir +'/'+ domain +'.zone'
+    zone = zone_template.substitute(domain=domain, serial=_next_serial(_zone_serial(zone_path)))
+    for host in _zone_hosts(domain, main):
+        zone += host +'   IN   A     '+ ip +'\n'
+    _write_file(zone_path, zone, 0644)
+
+
+def _zone_serial(path):
+    """
+    Read the serial of a zone file
+
+    Keyword argument:
+        path -- Zone file path
+
+    Returns:
+        Integer, 0 if the file or its serial doesn't exist
+
+    """
+    try:
+        with open(path) as f:
+            match = re.search(r'\sSOA\s+\S+\s+\S+\s+(\d+)', f.read())
+    except IOError:
+        return 0
+    return int(match.group(1)) if match else 0
+
+
+def _next_serial(serial=0):
+    """
+    Zone serial as YYYYMMDDnn, always greater than the former one even
+    after 100 changes a day
+
+    Keyword argument:
+        serial -- Former serial
+
+    Returns:
+        Integer
+
+    """
+    return max(int(time.strftime('%Y%m%d')) * 100, serial + 1)
+
+
+def _zone_hosts(domain, main=False):
+    """ Hosts of a zone given an A record, as fully qualified names """
+    hosts = zone_hosts + (main_zone_hosts if main else [])
+    return [ host + domain +'.' for host in hosts ]
+
+
+def _bind_stanza(domain):
+    conf_lines = [
+        'zone "'+ domain +'" {',
+        '    type master;',
+        '    file "'+ zones_dir +'/'+ domain +'.zone";',
+        '    update-policy local;',
+        '    allow-transfer {',
+        '        127.0.0.1;',
+        '        localnets;',
+        '    };',
+        '};'
+    ]
+    return ''.join(line + '\n' for line in conf_lines)
+
+
+def _bind_add(domain):
+    """
+    Write the bind configuration of a zone in its own file, and list it
+    in the index if it is not
+
+    Keyword argument:
+        domain -- Domain name
+
+    """
+    _bind_setup()
+    path = bind_zones_dir +'/'+ domain +'.conf'
+    listed = os.path.exists(path)
+    _write_file(path, _bind_stanza(domain), 0644)
+    if not listed:
+        with open(bind_index, 'a') as index:
+            fcntl.flock(index, fcntl.LOCK_EX)
+            index.write('include "'+ path +'";\n')
+
+
+def _bind_remove(domain):
+    """
+    Empty the bind configuration file of a zone
+
+    The file is kept, with its line in the index, so that removing a
+    domain doesn't rewrite the index. It is reused if the domain is
+    added again.
+
+    Keyword argument:
+        domain -- Domain name
+
+    """
+    _bind_setup()
+    path = bind_zones_dir +'/'+ domain +'.conf'
+    if os.path.exists(path):
+        _write_file(path, '// '+ domain +' has been removed\n', 0644)
+
+
+def _bind_zones():
+    """
+    List the zones managed by YunoHost
+
+    Returns:
+        List of (domain, bind configuration) tuples
+
+    """
+    zones = []
+    try:
+        names = sorted(os.listdir(bind_zones_dir))
+    except OSError:
+        return zones
+    for name in names:
+        if name.endswith('.conf'):
+            stanza = _bind_stanza_read(bind_zones_dir +'/'+ name)
+            if stanza:
+                zones.append((name[:-5], stanza))
+    return zones
+
+
+def _bind_stanza_read(path):
+    """ Read a zone configuration file, None if the zone has been removed """
+    with open(path) as f:
+        stanza = f.read()
+    return stanza if stanza.startswith('zone ') else None
+
+
+def _bind_setup():
+    """
+    Move the zones of named.conf.local written by former versions to
+    their own files, and include the index, once
+
+    """
+    if os.path.exists(bind_index):
+        return
+    if not os.path.isdir(bind_zones_dir):
+        os.makedirs(bind_zones_dir, 0755)
+
+    kept = []
+    zones = []
+    block = []
+    with open(bind_conf) as conf:
+        for line in conf:
+            match = re.match(r'^zone "([^"]+)"', line)
+            if match:
+                block = [ match.group(1), line ]
+            elif block:
+                block.append(line)
+            else:
+                kept.append(line)
+            if block and re.match(r'^};$', line.rstrip()):
+                domain, lines = block[0], block[1:]
+                if 'file "'+ zones_dir +'/'+ domain +'.zone";' in ''.join(lines):
+                    zones.append(domain)
+                    _write_file(bind_zones_dir +'/'+ domain +'.conf', ''.join(lines), 0644)
+                else:
+                    kept.extend(lines)
+                block = []
+    kept.extend(block[1:])
+
+    include = 'include "'+ bind_index +'";\n'
+    if include not in kept:
+        if kept and not kept[-1].endswith('\n'):
+            kept[-1] += '\n'
+        kept.append(include)
+    _write_file(bind_index, '// Zones managed by YunoHost, see '+ bind_zones_dir +'\n'+
+                ''.join('include "'+ bind_zones_dir +'/'+ domain +'.conf";\n' for domain in zones), 0644)
+    _write_file(bind_conf, ''.join(kept), 0644)
+
+
+def _rndc(command):
+    """
+    Run a bind control command, reloading bind if rndc fails
+
+    Keyword argument:
+        command -- reconfig to load the added and removed zones, reload
+                   to load the zone files too
+
+    """
+    if os.system('rndc '+ command) != 0:
+        os.system('service bind9 reload')
+
+
+def _domain_metronome(domain):
+    """
+    Write the XMPP virtual host of a domain, if there is none
+
+    Keyword argument:
+        domain -- Domain name
+
+    """
+    ssl_domain_path = certs_dir +'/'+ domain
+    if not os.path.exists('/etc/metronome/conf.d/'+ domain +'.cfg.lua'):
+        conf_lines = [
+            'VirtualHost "'+ domain +'"',
+            '  ssl = {',
+            '        key = "'+ ssl_domain_path +'/key.pem";',
+            '        certificate = "'+ ssl_domain_path +'/crt.pem";',
+            '  }',
+            '  authentication = "ldap2"',
+            '  ldap = {',
+            '     hostname      = "localhost",',
+            '     user = {',
+            '       basedn        = "ou=users,dc=yunohost,dc=org",',
+            '       filter        = "(&(objectClass=posixAccount)(mail=*@'+ domain +'))",',
+            '       usernamefield = "mail",',
+            '       namefield     = "cn",',
+            '       },',
+            '  }',
+        ]
+        with open('/etc/metronome/conf.d/' + domain + '.cfg.lua', 'w') as conf:
+            for line in conf_lines:
+                conf.write(line + '\n')
+
+    pep_dir = '/var/lib/metronome/'+ domain.replace('.', '%2e') +'/pep'
+    if not os.path.isdir(pep_dir):
+        os.makedirs(pep_dir)
+
+
+def _domain_nginx(domain):
+    """
+    Write the Nginx configuration of a domain from the template
+
+    Keyword argument:
+        domain -- Domain name
+
+    """
+    with open('/usr/share/yunohost/yunohost-config/nginx/template.conf') as f:
+        conf = f.read().replace('yunohost.org', domain)
+    with open('/etc/nginx/conf.d/'+ domain +'.conf', 'w') as f:
+        f.write(conf)
+    if not os.path.isdir('/etc/nginx/conf.d/'+ domain +'.d'):
+        os.mkdir('/etc/nginx/conf.d/'+ domain +'.d')
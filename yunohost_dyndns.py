@@ -25,11 +25,13 @@
 """
 import os
 import sys
-import requests
 import json
 import glob
 import base64
-from yunohost import YunoHostError, YunoHostLDAP, validate, colorize, win_msg
+from yunohost import YunoHostError, YunoHostLDAP, validate, colorize, win_msg, progress_msg, lazy_import
+
+requests = lazy_import('requests', 'python-requests')
+yunohost_domain = lazy_import('yunohost_domain')
 
 def dyndns_subscribe(subscribe_host="dyndns.yunohost.org", domain=None, key=None):
     """
@@ -88,7 +90,7 @@ def dyndns_update(dyn_host="dynhost.yunohost.org", domain=None, key=None, ip=Non
             domain = f.readline().rstrip()
 
     if ip is None:
-        new_ip = requests.get('http://ip.yunohost.org').text
+        new_ip = requests.get('http://ip.yunohost.org').text.strip()
     else:
         new_ip = ip
 
@@ -135,6 +137,13 @@ def dyndns_update(dyn_host="dynhost.yunohost.org", domain=None, key=None, ip=Non
             win_msg(_("IP successfully updated"))
             with open('/etc/yunohost/dyndns/old_ip', 'w') as f:
                 f.write(new_ip)
+            # Local zones serve the new address too, the update succeeded anyway
+            try:
+                yunohost_domain.domain_zonerefresh(ip=new_ip)
+            except YunoHostError, error:
+                progress_msg(_("Local zones not refreshed: ") + error.message)
+            except EnvironmentError, error:
+                progress_msg(_("Local zones not refreshed: ") + str(error))
         else:
             os.remove('/etc/yunohost/dyndns/old_ip')
             raise YunoHostError(1, _("An error occured during DynDNS update"))
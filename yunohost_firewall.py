@@ -25,18 +25,10 @@
 """
 import os
 import sys
-try:
-    import miniupnpc
-except ImportError:
-    sys.stderr.write('Error: Yunohost CLI Require miniupnpc lib\n')
-    sys.exit(1)
-try:
-    import yaml
-except ImportError:
-    sys.stderr.write('Error: Yunohost CLI Require yaml lib\n')
-    sys.stderr.write('apt-get install python-yaml\n')
-    sys.exit(1)
-from yunohost import YunoHostError, win_msg
+from yunohost import YunoHostError, win_msg, lazy_import
+
+miniupnpc = lazy_import('miniupnpc', 'python-miniupnpc')
+yaml = lazy_import('yaml', 'python-yaml')
 
 
 def firewall_allow(protocol=None, port=None, ipv6=None, upnp=False):
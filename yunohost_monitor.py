@@ -25,12 +25,13 @@
 """
 import re
 import json
-import psutil
 import subprocess
-import xmlrpclib
 from urllib import urlopen
 from datetime import datetime, timedelta
-from yunohost import YunoHostError
+from yunohost import YunoHostError, lazy_import
+
+psutil = lazy_import('psutil', 'python-psutil')
+xmlrpclib = lazy_import('xmlrpclib')
 
 glances_uri = 'http://127.0.0.1:61209'
 
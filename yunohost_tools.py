@@ -25,17 +25,18 @@
 """
 import os
 import sys
-import yaml
 import re
 import getpass
 import subprocess
-import requests
 import json
-from yunohost import YunoHostError, YunoHostLDAP, validate, colorize, get_required_args, win_msg
-from yunohost_domain import domain_add, domain_list
-from yunohost_dyndns import dyndns_subscribe
-from yunohost_backup import backup_init
-from yunohost_app import app_ssowatconf
+from yunohost import YunoHostError, YunoHostLDAP, validate, colorize, get_required_args, win_msg, lazy_import, invalidate_search_cache
+
+yaml = lazy_import('yaml', 'python-yaml')
+requests = lazy_import('requests', 'python-requests')
+yunohost_domain = lazy_import('yunohost_domain')
+yunohost_dyndns = lazy_import('yunohost_dyndns')
+yunohost_backup = lazy_import('yunohost_backup')
+yunohost_app = lazy_import('yunohost_app')
 
 
 def tools_ldapinit(password=None):
@@ -87,7 +88,10 @@ def tools_ldapinit(password=None):
     sid = subprocess.check_output(['net', 'getlocalsid', 'YUNOHOST']).strip().split(':')[1][1:]
     os.system('echo \'SID="'+ sid +'"\' >> /etc/smbldap-tools/smbldap.conf')
     if password is not None:
-        os.system('echo "'+ password +'\n'+ password +'" | smbldap-populate')
+        # Given on stdin, so the password doesn't show in the process list
+        populate = subprocess.Popen(['smbldap-populate'], stdin=subprocess.PIPE)
+        populate.communicate(password +'\n'+ password +'\n')
+    invalidate_search_cache()
 
     win_msg(_("LDAP has been successfully initialized"))
 
@@ -108,6 +112,7 @@ def tools_adminpw(old_password, new_password):
     result  = os.system('ldappasswd -h localhost -D cn=admin,dc=yunohost,dc=org -w "'+ old_password +'" -a "'+ old_password +'" -s "' + new_password + '"')
     result2 = os.system('smbpasswd -w "'+ new_password + '"')
 
+    # Also drops the credentials cached by the API server, see ldap_credentials_stamp
     os.system('rm /etc/smbldap-tools/smbldap_bind.conf')
     with open('/etc/smbldap-tools/smbldap_bind.conf', 'w') as f:
         lines = [
@@ -165,7 +170,7 @@ def tools_maindomain(old_domain, new_domain, dyndns=False):
             for line in lines:
                 sources.write(re.sub(r''+ old_domain +'', new_domain, line))
 
-    domain_add([new_domain], main=True)
+    yunohost_domain.domain_add([new_domain], main=True)
 
     os.system('rm /etc/ssl/private/yunohost_key.pem')
     os.system('rm /etc/ssl/certs/yunohost_crt.pem')
@@ -190,13 +195,13 @@ def tools_maindomain(old_domain, new_domain, dyndns=False):
         if os.system(command) != 0:
             raise YunoHostError(17, _("There were a problem during domain changing"))
 
-    if dyndns: dyndns_subscribe(domain=new_domain)
+    if dyndns: yunohost_dyndns.dyndns_subscribe(domain=new_domain)
     elif len(new_domain.split('.')) >= 3:
         r = requests.get('http://dyndns.yunohost.org/domains')
         dyndomains = json.loads(r.text)
         dyndomain  = '.'.join(new_domain.split('.')[1:])
         if dyndomain in dyndomains:
-            dyndns_subscribe(domain=new_domain)
+            yunohost_dyndns.dyndns_subscribe(domain=new_domain)
 
     win_msg(_("Main domain has been successfully changed"))
 
@@ -287,13 +292,13 @@ def tools_postinstall(domain, password, dyndns=False):
         tools_ldapinit(password)
 
         # Initialize backup system
-        backup_init()
+        yunohost_backup.backup_init()
 
         # New domain config
         tools_maindomain(old_domain='yunohost.org', new_domain=domain, dyndns=dyndns)
 
         # Generate SSOwat configuration file
-        app_ssowatconf()
+        yunohost_app.app_ssowatconf()
 
         # Change LDAP admin password
         tools_adminpw(old_password='yunohost', new_password=password)
@@ -30,60 +30,100 @@ import crypt
 import random
 import string
 import getpass
-from yunohost import YunoHostError, YunoHostLDAP, win_msg, colorize, validate, get_required_args
+import csv
+import json
+import time
+import base64
+import hashlib
+import shutil
+import errno
+from multiprocessing.pool import ThreadPool
+from ldap.filter import escape_filter_chars
+from yunohost import YunoHostError, YunoHostLDAP, win_msg, progress_msg, colorize, validate, get_required_args, get_validator, invalidate_search_cache, ssowat_refresh
 from yunohost_domain import domain_list
 
-def user_list(fields=None, filter=None, limit=None, offset=None):
+username_pattern = '^[a-z0-9_]+$'
+mail_pattern = '^[\w.-]+@[\w.-]+\.[a-zA-Z]{2,6}$'
+# Group and shell given by smbldap-useradd, for the users created in LDAP directly
+users_gid = '513'
+users_shell = '/bin/false'
+# Number of users added or removed in LDAP at once
+ldap_batch = 50
+# Number of home directories removed at once by user_delete()
+purge_workers = 4
+
+def user_list(fields=None, filter=None, limit=None, offset=None, cursor=None):
     """
-    List users
+    List users, by order of creation
+
+    Pages after the first one are fetched with the cursor returned as Next,
+    which stays valid when users are added or deleted meanwhile. The last
+    page has no Next, and may be empty.
 
     Keyword argument:
         filter -- LDAP filter used to search
         offset -- Starting number for user fetching
         limit -- Maximum number of user fetched
         fields -- fields to fetch
+        cursor -- Next value returned with the previous page
+
+    Returns:
+        Dict of users, empty when none matches, and the cursor of the next page if any
 
     """
     with YunoHostLDAP() as yldap:
-        user_attrs = ['uid', 'mail', 'cn', 'maildrop']
-        attrs = []
+        user_attrs = { 'uid': 'Username', 'cn': 'Fullname', 'mail': 'Mail', 'maildrop': 'Mail Forward' }
         result_list = []
-        if offset: offset = int(offset)
+        result = {}
+        if offset: offset = max(int(offset), 0)
         else: offset = 0
         if limit: limit = int(limit)
         else: limit = 1000
         if not filter: filter = 'uid=*'
         if fields:
-            for attr in fields.items():
-                if attr in user_attrs:
-                    attrs.append(attr)
-                    continue
-                else:
+            if not isinstance(fields, list):
+                fields = [ fields ]
+            for attr in fields:
+                if attr not in user_attrs:
                     raise YunoHostError(22, _("Invalid field : ") + attr)
+            attrs = fields
         else:
-            attrs = user_attrs
-
-        result = yldap.search('ou=users,dc=yunohost,dc=org', filter, attrs)
-
-        if result and len(result) > (0 + offset) and limit > 0:
-            i = 0 + offset
-            for user in result[i:]:
-                if i - offset < limit:
-                    if user['uid'][0] == 'root' or user['uid'][0] == 'nobody':
+            attrs = ['uid', 'cn', 'mail']
+
+        # System accounts are excluded by the server, so pages are complete
+        if not filter.startswith('('):
+            filter = '('+ filter +')'
+        filter = '(&'+ filter +'(!(uid=root))(!(uid=nobody))'
+        if cursor:
+            if not str(cursor).isdigit():
+                raise YunoHostError(22, _("Invalid cursor : ") + str(cursor))
+            filter += '(uidNumber>='+ str(cursor) +')'
+        filter += ')'
+
+        # Stop fetching once the requested page and the next user are fetched
+        if limit > 0:
+            users = yldap.search_iter('ou=users,dc=yunohost,dc=org', filter, attrs + ['uidNumber'],
+                                      scope=ldap.SCOPE_ONELEVEL, page_size=min(offset + limit + 1, 500),
+                                      sort=['uidNumber'])
+            try:
+                for i, user in enumerate(users):
+                    if i < offset:
                         continue
-                    entry = {
-                        'Username': user['uid'][0],
-                        'Fullname': user['cn'][0],
-                    }
-                    if 'mail' in user.keys():
-                        entry['Mail'] = user['mail'][0]
-
+                    if len(result_list) >= limit:
+                        result['Next'] = user['uidNumber'][0]
+                        break
+                    entry = {}
+                    for attr in attrs:
+                        if attr == 'maildrop':
+                            entry[user_attrs[attr]] = user.get(attr, [])[1:]
+                        elif attr in user:
+                            entry[user_attrs[attr]] = user[attr][0]
                     result_list.append(entry)
-                    i += 1
-        else:
-            raise YunoHostError(167, _("No user found"))
+            finally:
+                users.close()
 
-    return { 'Users' : result_list }
+    result['Users'] = result_list
+    return result
 
 
 def user_create(username, firstname, lastname, mail, password):
@@ -106,16 +146,21 @@ def user_create(username, firstname, lastname, mail, password):
         yldap.validate_uniqueness({
             'uid'       : username,
             'mail'      : mail
-        })
+        }, base='ou=users,dc=yunohost,dc=org')
 
         if mail[mail.find('@')+1:] not in domain_list()['Domains']:
             raise YunoHostError(22, _("Domain not found : ")+ mail[mail.find('@')+1:])
 
-        user_added  = os.system('/usr/sbin/smbldap-useradd -a -A 1 -m -M "'+ mail +'" -N "'+ firstname +'" -S "'+ lastname +'" -Z "objectclass=mailAccount,maildrop='+ username +'" -p '+ username)
-        pwd_changed = os.system('echo "'+ password +'\n'+ password +'" | smbldap-passwd '+ username)
+        user_added = os.system('/usr/sbin/smbldap-useradd -a -A 1 -m -M "'+ mail +'" -N "'+ firstname +'" -S "'+ lastname +'" -Z "objectclass=mailAccount,maildrop='+ username +'" '+ username)
+        # smbldap tools modify the directory behind YunoHostLDAP
+        invalidate_search_cache('ou=users,dc=yunohost,dc=org')
 
-        if user_added == pwd_changed == 0:
-            os.system('yunohost app ssowatconf > /dev/null 2>&1')
+        # The password is hashed in process rather than by smbldap-passwd
+        password_attrs = _password_attrs(password)
+        password_attrs['sambaAcctFlags'] = '[U          ]'
+        # Given as missing from the entry, so that the attributes without value are deleted
+        if user_added == 0 and yldap.update('uid='+ username +',ou=users', password_attrs, old_attr_dict={}):
+            ssowat_refresh()
             #TODO: Send a welcome mail to user
             win_msg(_("User successfully created"))
             return { _("Fullname") : firstname +' '+ lastname, _("Username") : username, _("Mail") : mail }
@@ -125,33 +170,84 @@ def user_create(username, firstname, lastname, mail, password):
 
 def user_delete(users, purge=False):
     """
-    Delete user
+    Delete users
+
+    Users are removed from LDAP by batches along with their group
+    memberships, and their home directories are purged in parallel. A
+    failure doesn't stop the deletion of the other users.
 
     Keyword argument:
         users -- Username of users to delete
-        purge
+        purge -- Remove home directories
 
-    """
-    with YunoHostLDAP() as yldap:
-        result = { 'Users' : [] }
+    Returns:
+        Dict of deleted users, and of the reason of every failure
 
-        if not isinstance(users, list):
-            users = [ users ]
+    """
+    if not isinstance(users, list):
+        users = [ users ]
+    users = [ user for i, user in enumerate(users) if user not in users[:i] ]
 
+    deleted = []
+    failed = {}
+    with YunoHostLDAP() as yldap:
+        found = yldap.search('ou=users,dc=yunohost,dc=org', _uid_filter(users),
+                             ['uid', 'homeDirectory'], scope=ldap.SCOPE_ONELEVEL, cache=False) or []
+        homes = dict((user['uid'][0], user.get('homeDirectory', ['/home/'+ user['uid'][0]])[0])
+                     for user in found)
         for user in users:
-            delete_command = '/usr/sbin/smbldap-userdel'
-            if purge:
-                delete_command = delete_command +' -r '+ user
-            else:
-                delete_command = delete_command +' '+ user
-            user_deleted = os.system(delete_command)
-            if user_deleted == 0:
-                result['Users'].append(user)
-            else:
-                raise YunoHostError(169, _("An error occured during user deletion"))
-
-        os.system('yunohost app ssowatconf > /dev/null 2>&1')
-        win_msg(_("User(s) successfully deleted"))
+            if user not in homes:
+                failed[user] = _("Unknown user")
+        users = [ user for user in users if user in homes ]
+
+        for start in range(0, len(users), ldap_batch):
+            batch = users[start:start + ldap_batch]
+            try:
+                yldap.remove_many([ 'uid='+ user +',ou=users' for user in batch ])
+                deleted.extend(batch)
+            except YunoHostError:
+                # Find out which users of the batch are still there
+                remaining = yldap.search('ou=users,dc=yunohost,dc=org', _uid_filter(batch),
+                                         ['uid'], scope=ldap.SCOPE_ONELEVEL, cache=False) or []
+                remaining = set(user['uid'][0] for user in remaining)
+                for user in batch:
+                    if user in remaining:
+                        failed[user] = _("An error occured during user deletion")
+                    else:
+                        deleted.append(user)
+
+        # Remove the users from their groups, like smbldap-userdel
+        if deleted:
+            groups = yldap.search('ou=groups,dc=yunohost,dc=org',
+                                  '(&(objectClass=posixGroup)'+ _uid_filter(deleted, 'memberUid') +')',
+                                  ['dn', 'memberUid'], cache=False) or []
+            try:
+                yldap.update_many([ (group['dn'][0][:-len(yldap.base) - 1],
+                                     { 'memberUid': [ uid for uid in group['memberUid'] if uid not in deleted ] },
+                                     { 'memberUid': group['memberUid'] })
+                                    for group in groups ])
+            except YunoHostError as e:
+                progress_msg(e.message)
+
+    if purge and deleted:
+        pool = ThreadPool(min(purge_workers, len(deleted)))
+        try:
+            for user, error in pool.imap_unordered(_purge_home, [ (user, homes[user]) for user in deleted ]):
+                if error:
+                    failed[user] = _("Unable to remove home directory : ") + error
+        finally:
+            pool.close()
+
+    if not deleted:
+        raise YunoHostError(169, _("An error occured during user deletion") +' : '+
+                            ', '.join(user +' ('+ reason +')' for user, reason in sorted(failed.items())))
+
+    ssowat_refresh()
+
+    result = { 'Users' : deleted }
+    if failed:
+        result['Failed'] = failed
+    win_msg(_("User(s) successfully deleted"))
     return result
 
 
@@ -177,10 +273,19 @@ def user_update(username, firstname=None, lastname=None, mail=None, change_passw
         domains = domain_list()['Domains']
 
         # Populate user informations
-        result = yldap.search(base='ou=users,dc=yunohost,dc=org', filter='uid=' + username, attrs=attrs_to_fetch)
+        # Read from the directory, the modifications are computed from these values
+        result = yldap.search(base='ou=users,dc=yunohost,dc=org', filter='uid=' + username, attrs=attrs_to_fetch, cache=False)
         if not result:
             raise YunoHostError(167, _("No user found"))
         user = result[0]
+        old_user = dict((attr, list(values)) for attr, values in user.items())
+
+        # Check every new address in one LDAP search
+        if add_mailalias and not isinstance(add_mailalias, list):
+            add_mailalias = [ add_mailalias ]
+        new_mails = ([ mail ] if mail else []) + (add_mailalias or [])
+        if new_mails:
+            yldap.validate_uniqueness({ 'mail': new_mails }, base='ou=users,dc=yunohost,dc=org')
 
         # Get modifications from arguments
         if firstname:
@@ -195,22 +300,18 @@ def user_update(username, firstname=None, lastname=None, mail=None, change_passw
             new_attr_dict['cn'] = new_attr_dict['displayName'] = firstname + ' ' + lastname
 
         if change_password:
-            pwd_changed = os.system('echo "'+ change_password +'\n'+ change_password +'" | smbldap-passwd '+ username)
-            if pwd_changed > 0:
-                raise YunoHostError(169, _("An error occured during password update"))
+            if len(change_password) < 4:
+                raise YunoHostError(22, _("Password is too short"))
+            new_attr_dict.update(_password_attrs(change_password))
 
         if mail:
-            yldap.validate_uniqueness({ 'mail': mail })
             if mail[mail.find('@')+1:] not in domains:
                 raise YunoHostError(22, _("Domain not found : ")+ mail[mail.find('@')+1:])
             del user['mail'][0]
             new_attr_dict['mail'] = [mail] + user['mail']
 
         if add_mailalias:
-            if not isinstance(add_mailalias, list):
-                add_mailalias = [ add_mailalias ]
             for mail in add_mailalias:
-                yldap.validate_uniqueness({ 'mail': mail })
                 if mail[mail.find('@')+1:] not in domains:
                     raise YunoHostError(22, _("Domain not found : ")+ mail[mail.find('@')+1:])
                 user['mail'].append(mail)
@@ -245,7 +346,7 @@ def user_update(username, firstname=None, lastname=None, mail=None, change_passw
                     raise YunoHostError(22, _("Invalid mail forward : ") + mail)
             new_attr_dict['maildrop'] = user['maildrop']
 
-        if yldap.update('uid=' + username + ',ou=users', new_attr_dict):
+        if yldap.update('uid=' + username + ',ou=users', new_attr_dict, old_attr_dict=old_user):
            win_msg(_("User successfully updated"))
            return user_info(username)
         else:
@@ -295,3 +396,386 @@ def user_info(username):
         else:
             raise YunoHostError(167, _("No user found"))
 
+
+def user_import(file, format=None):
+    """
+    Create users from a CSV or JSON file
+
+    Every row is validated before any user is created, with a single LDAP
+    search for the uniqueness of usernames and mails. Users are then added
+    directly in LDAP by batches, and SSOwat is regenerated once.
+
+    Keyword argument:
+        file -- CSV or JSON file of users, '-' for standard input
+        format -- csv or json (default from the file extension)
+
+    Returns:
+        Dict of created and failed usernames, users whose home directory
+        could not be created are failed
+
+    """
+    rows = list(_read_users(file, format))
+    if not rows:
+        raise YunoHostError(22, _("No user to import"))
+    progress_msg(_("Validating %d users") % len(rows))
+
+    with YunoHostLDAP() as yldap:
+        domains = set(domain_list()['Domains'])
+        username_validator = get_validator(username_pattern)
+        mail_validator = get_validator(mail_pattern)
+        errors = []
+        usernames = set()
+        mails = set()
+        for line, row in enumerate(rows, 1):
+            missing = [field for field in ['username', 'firstname', 'lastname', 'mail', 'password'] if not row.get(field)]
+            if missing:
+                errors.append(_("Row %d: missing %s") % (line, ', '.join(missing)))
+                continue
+            if not username_validator.match(row['username']):
+                errors.append(_("Row %d: invalid username %s") % (line, row['username']))
+            elif row['username'] in usernames:
+                errors.append(_("Row %d: duplicate username %s") % (line, row['username']))
+            if not mail_validator.match(row['mail']):
+                errors.append(_("Row %d: invalid mail %s") % (line, row['mail']))
+            elif row['mail'] in mails:
+                errors.append(_("Row %d: duplicate mail %s") % (line, row['mail']))
+            elif row['mail'][row['mail'].find('@')+1:] not in domains:
+                errors.append(_("Row %d: domain not found : %s") % (line, row['mail'][row['mail'].find('@')+1:]))
+            if len(row['password']) < 4:
+                errors.append(_("Row %d: password is too short") % line)
+            usernames.add(row['username'])
+            mails.add(row['mail'])
+        if errors:
+            raise YunoHostError(22, '\n'.join(errors))
+
+        yldap.validate_uniqueness({
+            'uid'       : [ row['username'] for row in rows ],
+            'mail'      : [ row['mail'] for row in rows ]
+        }, base='ou=users,dc=yunohost,dc=org')
+
+        first_uid, domain_sid = _allocate_uids(yldap, len(rows))
+        for i, row in enumerate(rows):
+            row['uidNumber'] = first_uid + i
+
+        created = []
+        failed = []
+        for start in range(0, len(rows), ldap_batch):
+            batch = rows[start:start + ldap_batch]
+            try:
+                yldap.add_many([('uid='+ row['username'] +',ou=users', _user_entry(row, domain_sid))
+                                for row in batch])
+                added = batch
+            except YunoHostError:
+                # Find out which users of the batch were created
+                existing = yldap.search('ou=users,dc=yunohost,dc=org',
+                                        _uid_filter([ row['username'] for row in batch ]),
+                                        ['uid'], cache=False) or []
+                existing = set(user['uid'][0] for user in existing)
+                added = [ row for row in batch if row['username'] in existing ]
+                failed.extend(row['username'] for row in batch if row['username'] not in existing)
+
+            for row in added:
+                try:
+                    _create_home(row['username'], row['uidNumber'])
+                except EnvironmentError, error:
+                    # The user exists in LDAP, without home directory
+                    progress_msg(_("Home directory of %s not created : %s") % (row['username'], error))
+                    failed.append(row['username'])
+                else:
+                    created.append(row['username'])
+            progress_msg(_("%d/%d users imported") % (start + len(batch), len(rows)))
+
+    ssowat_refresh()
+
+    result = { 'Created': created }
+    if failed:
+        result['Failed'] = failed
+    win_msg(_("%d users successfully imported") % len(created))
+    return result
+
+
+def user_export(output=None, format=None):
+    """
+    Export users to a CSV or JSON file
+
+    Users are streamed from LDAP to the file. A JSON file holds one user
+    per line, as read by user_import().
+
+    Keyword argument:
+        output -- File to write, '-' for standard output
+        format -- csv or json (default from the file extension, or csv)
+
+    Returns:
+        Dict of the users if no output is given, else of the number of exported users
+
+    """
+    fields = ['username', 'firstname', 'lastname', 'mail', 'mail_aliases', 'mail_forwards']
+    if not format:
+        format = 'json' if output and output.endswith('.json') else 'csv'
+
+    with YunoHostLDAP() as yldap:
+        users = yldap.search_iter('ou=users,dc=yunohost,dc=org', 'uid=*',
+                                  ['uid', 'givenName', 'sn', 'mail', 'maildrop'],
+                                  scope=ldap.SCOPE_ONELEVEL, page_size=500, cache=False)
+        rows = (_export_row(user) for user in users
+                if user['uid'][0] not in ['root', 'nobody'])
+        if output is None:
+            return { 'Users': list(rows) }
+
+        count = 0
+        try:
+            f = sys.stdout if output == '-' else open(output, 'w')
+        except IOError:
+            raise YunoHostError(22, _("Unable to write file : ") + output)
+        try:
+            if format == 'csv':
+                writer = csv.DictWriter(f, fields)
+                writer.writeheader()
+                for row in rows:
+                    row['mail_aliases'] = ' '.join(row['mail_aliases'])
+                    row['mail_forwards'] = ' '.join(row['mail_forwards'])
+                    writer.writerow(row)
+                    count += 1
+            else:
+                for row in rows:
+                    f.write(json.dumps(row) +'\n')
+                    count += 1
+        finally:
+            if f is not sys.stdout:
+                f.close()
+
+    if output != '-':
+        win_msg(_("%d users exported") % count)
+        return { 'Exported': count, 'File': output }
+
+
+def set_passwords(yldap, passwords):
+    """
+    Set passwords of many users at once, without reading their entries
+
+    Keyword argument:
+        yldap -- YunoHostLDAP instance
+        passwords -- Dict of usernames/clear passwords
+
+    Returns:
+        Boolean | YunoHostError
+
+    """
+    for username, password in passwords.items():
+        if len(password) < 4:
+            raise YunoHostError(22, _("Password is too short") +' : '+ username)
+
+    passwords = passwords.items()
+    for start in range(0, len(passwords), ldap_batch):
+        yldap.update_many([ ('uid='+ username +',ou=users', _password_attrs(password), None)
+                            for username, password in passwords[start:start + ldap_batch] ])
+    return True
+
+
+def _read_users(file, format=None):
+    """
+    Read users to import from a CSV file with a header line, or a JSON file
+    holding either a list or one object per line
+
+    Keyword argument:
+        file -- Path of the file, '-' for standard input
+        format -- csv or json (default from the file extension)
+
+    Returns:
+        Generator of Dict
+
+    """
+    if not format:
+        format = 'json' if file.endswith('.json') else 'csv'
+    try:
+        f = sys.stdin if file == '-' else open(file)
+    except IOError:
+        raise YunoHostError(22, _("Unable to read file : ") + file)
+
+    try:
+        if format == 'csv':
+            rows = csv.DictReader(f)
+        else:
+            content = f.read()
+            try:
+                if content.lstrip().startswith('['):
+                    rows = json.loads(content)
+                else:
+                    rows = [ json.loads(line) for line in content.splitlines() if line.strip() ]
+            except ValueError:
+                raise YunoHostError(22, _("Invalid JSON file : ") + file)
+
+        for row in rows:
+            user = {}
+            for key, value in row.items():
+                if isinstance(key, unicode):
+                    key = key.encode('utf-8')
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                if isinstance(key, basestring) and isinstance(value, basestring):
+                    user[key.strip()] = value.strip()
+            yield user
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _allocate_uids(yldap, count):
+    """
+    Reserve consecutive Unix IDs in the Samba ID pool, like smbldap-useradd
+
+    Keyword argument:
+        yldap -- YunoHostLDAP instance
+        count -- Number of IDs
+
+    Returns:
+        Tuple of the first ID and the Samba domain SID
+
+    """
+    pool = yldap.search(filter='(&(objectClass=sambaDomain)(objectClass=sambaUnixIdPool))',
+                        attrs=['dn', 'uidNumber', 'sambaSID'], cache=False)
+    if not pool:
+        raise YunoHostError(167, _("Samba ID pool not found, please run 'yunohost tools ldapinit'"))
+    first = int(pool[0]['uidNumber'][0])
+
+    # Delete then add the value, so a concurrent allocation makes it fail
+    try:
+        yldap.conn.modify_ext_s(pool[0]['dn'][0], [
+            (ldap.MOD_DELETE, 'uidNumber', [ str(first) ]),
+            (ldap.MOD_ADD, 'uidNumber', [ str(first + count) ])
+        ])
+    except ldap.LDAPError:
+        raise YunoHostError(169, _("Unable to allocate user IDs, please try again"))
+    return first, pool[0]['sambaSID'][0]
+
+
+def _password_attrs(password):
+    """
+    Compute the attributes smbldap-passwd sets for a password: userPassword
+    as salted SHA1, sambaNTPassword and the dates of change
+
+    Keyword argument:
+        password -- Clear password
+
+    Returns:
+        Dict of attributes/values, sambaNTPassword is None if MD4 is not available
+
+    """
+    salt = os.urandom(4)
+    now = int(time.time())
+    attrs = {
+        'userPassword'    : '{SSHA}' + base64.b64encode(hashlib.sha1(password + salt).digest() + salt),
+        'sambaNTPassword' : None,
+        'sambaPwdLastSet' : str(now),
+        'shadowLastChange': str(now / 86400)
+    }
+    try:
+        nt = hashlib.new('md4', password.decode('utf-8').encode('utf-16le'))
+        attrs['sambaNTPassword'] = nt.hexdigest().upper()
+    except ValueError:
+        # MD4 not provided by this OpenSSL build, the former hash is removed
+        pass
+    return attrs
+
+
+def _user_entry(row, domain_sid):
+    """
+    Build the LDAP entry smbldap-useradd would create for a user
+
+    Keyword argument:
+        row -- Dict of username, firstname, lastname, mail, password and uidNumber
+        domain_sid -- Samba domain SID
+
+    Returns:
+        Dict of attributes/values
+
+    """
+    fullname = row['firstname'] +' '+ row['lastname']
+    entry = {
+        'objectClass'         : ['mailAccount', 'inetOrgPerson', 'posixAccount', 'shadowAccount', 'sambaSamAccount'],
+        'uid'                 : row['username'],
+        'cn'                  : fullname,
+        'displayName'         : fullname,
+        'givenName'           : row['firstname'],
+        'sn'                  : row['lastname'],
+        'mail'                : row['mail'],
+        'maildrop'            : row['username'],
+        'uidNumber'           : str(row['uidNumber']),
+        'gidNumber'           : users_gid,
+        'homeDirectory'       : '/home/'+ row['username'],
+        'loginShell'          : users_shell,
+        'sambaSID'            : domain_sid +'-'+ str(2 * row['uidNumber'] + 1000),
+        'sambaPrimaryGroupSID': domain_sid +'-'+ users_gid,
+        'sambaAcctFlags'      : '[U          ]',
+        'sambaPwdCanChange'   : '0'
+    }
+    entry.update((attr, value) for attr, value in _password_attrs(row['password']).items()
+                 if value is not None)
+    return entry
+
+
+def _create_home(username, uid_number):
+    """
+    Create a home directory from /etc/skel
+
+    Keyword argument:
+        username -- Owner of the home directory
+        uid_number -- Unix ID of the owner
+
+    """
+    home = '/home/'+ username
+    if not os.path.exists(home):
+        shutil.copytree('/etc/skel', home, symlinks=True)
+    for root, dirs, files in os.walk(home):
+        for path in [root] + [ os.path.join(root, name) for name in dirs + files ]:
+            os.lchown(path, uid_number, int(users_gid))
+    os.chmod(home, 0700)
+
+
+def _export_row(user):
+    return {
+        'username'     : user['uid'][0],
+        'firstname'    : user.get('givenName', [''])[0],
+        'lastname'     : user.get('sn', [''])[0],
+        'mail'         : user.get('mail', [''])[0],
+        'mail_aliases' : user.get('mail', [])[1:],
+        'mail_forwards': user.get('maildrop', [])[1:]
+    }
+
+
+def _uid_filter(users, attr='uid'):
+    """
+    Build an LDAP filter matching any of the given usernames
+
+    Keyword argument:
+        users -- List of usernames
+        attr -- Attribute holding the username
+
+    Returns:
+        String
+
+    """
+    return '(|'+ ''.join('('+ attr +'='+ escape_filter_chars(user) +')' for user in users) +')'
+
+
+def _purge_home(args):
+    """
+    Remove a home directory, in a worker thread of user_delete()
+
+    Keyword argument:
+        args -- Tuple of the username and home directory
+
+    Returns:
+        Tuple of the username and the error message, if any
+
+    """
+    user, home = args
+    # Never follow a homeDirectory pointing to the root of the tree
+    if os.path.realpath(home) in ['/', '/home']:
+        return user, _("Invalid path ") + home
+    try:
+        shutil.rmtree(home)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            return user, e.strerror
+    return user, None